@@ -1,19 +1,40 @@
 import os
 import flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_bootstrap import Bootstrap
 from flask_pagedown import PageDown
 
+from myapp.sharding import ShardedSQLAlchemy, shard_binds
+
 # gives current directory of this file
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+# Number of databases the flashcards, decks and statistics of users are spread over
+SHARD_COUNT = 1
+
 # instance of the Flask class
 myapp_obj = flask.Flask(__name__)
 myapp_obj.config.from_mapping(
     SECRET_KEY = 'you-cannot-guess',
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db'),
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_BINDS = shard_binds(basedir, SHARD_COUNT), # Shard k > 0 is saved in app-shard<k>.db
+    SQLALCHEMY_TRACK_MODIFICATIONS = False,
+    SHARD_COUNT = SHARD_COUNT,
+    IMPORT_MAX_WORKERS = None, # Processes used to parse imported archives, None uses the number of CPUs
+    IMPORT_BATCH_SIZE = 1000, # Flashcards inserted per batch when importing
+    IMPORT_MAX_FILE_SIZE = 4 * 1024 * 1024, # Largest markdown file accepted inside an archive
+    BACKUP_DIR = os.path.join(basedir, 'backups'), # Where database snapshots are saved
+    BACKUP_KEEP = 7, # Number of newest snapshots kept
+    BACKUP_PAGES_PER_STEP = 256, # Database pages copied per backup step
+    BACKUP_STEP_SLEEP = 0.005, # Seconds paused between backup steps, to let requests use the database
+    PROFILE_MEMORY = False, # Trace allocations of requests with tracemalloc, see myapp.profiling
+    PROFILE_MEMORY_TOP = 10, # Allocation sites recorded per endpoint, 0 to skip the (slow) snapshots
+    PROFILE_MEMORY_FRAMES = 1, # Stack frames saved per traced allocation
+    MEMORY_BUDGETS = {}, # Mapping of endpoints to the most bytes a request may allocate
+    MEMORY_BUDGET_ACTION = 'log', # 'log' or 'raise' (MemoryBudgetExceeded) when a budget is exceeded
+    SYNC_PAGE_SIZE = 500, # Largest number of flashcard changes returned per sync request
+    SYNC_MAX_EVENTS = 1000, # Largest number of review events uploaded per sync request
+    FRAGMENT_CACHE_SIZE = 128, # Rendered template fragments kept in memory, 0 disables the cache
 )
 myapp_obj.config['BOOTSTRAP_BOOTSWATCH_THEME'] = 'sketchy'
 
@@ -21,7 +42,7 @@ myapp_obj.config['BOOTSTRAP_BOOTSWATCH_THEME'] = 'sketchy'
 bootstrap = Bootstrap(myapp_obj)
 
 # Install Sqlalchemy
-db = SQLAlchemy(myapp_obj)
+db = ShardedSQLAlchemy(myapp_obj)
 
 # Install LoginManager
 login = LoginManager(myapp_obj)
@@ -31,4 +52,4 @@ pagedown = PageDown(myapp_obj)
 
 pagedown = PageDown(myapp_obj)
 
-from myapp import routes, models
+from myapp import routes, models, assets, backup, rebalance, upgrade, profiling, sync, fragments
@@ -0,0 +1,198 @@
+"""This module holds the static asset pipeline of our app.
+
+The `build-static` command copies every file of the static folder into
+`static/dist/` under a fingerprinted name (its content hash is part of the
+name), writes gzip/brotli compressed siblings of text assets, optionally
+transcodes the GIF demos into animated WebP, and saves a `manifest.json`
+mapping the original names to the fingerprinted ones. Relative `url()`
+references of CSS files (like `url(./images/tomato.jpg)`) are rewritten to
+the fingerprinted files, before the CSS files themselves are fingerprinted:
+
+```
+cd app && FLASK_APP=run flask build-static --transcode-gifs
+```
+
+When a manifest exists, `url_for('static', filename=...)` returns the fingerprinted
+name, and fingerprinted files are served with a one year immutable `Cache-Control`,
+choosing the precompressed (or WebP) variant that the browser accepts.
+Without a manifest, static files are served by Flask as usual.
+
+"""
+import os
+import io
+import re
+import json
+import gzip
+import shutil
+import hashlib
+import posixpath
+import mimetypes
+
+import click
+from flask import request, send_from_directory
+from werkzeug.security import safe_join
+
+from myapp import myapp_obj
+
+try:
+    import brotli
+except ImportError: # brotli is optional, only gzip siblings are written without it
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.html', '.json', '.txt', '.map'}
+ONE_YEAR = 365 * 24 * 60 * 60
+R_CSS_URL = re.compile(r'''url\(\s*(?P<quote>['"]?)(?P<url>[^'"()\s]+)(?P=quote)\s*\)''')
+
+_manifest = {}
+
+
+def _fingerprinted_name(path, content):
+    """Insert the content hash before the file extension, like `base.css` -> `base.0123456789ab.css`"""
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.{digest}{ext}'
+
+
+def _rewrite_css_urls(rel_path, content, manifest):
+    """Rewrite the relative `url()` references of a CSS file, so they still resolve once the file
+    is moved into `dist/`: to the fingerprinted file when it's in the manifest, otherwise to the original file
+    """
+    css_dir = posixpath.dirname(rel_path)
+    dist_css_dir = posixpath.join(DIST_DIR, css_dir)
+
+    def rewrite(match):
+        url = match.group('url')
+        if url.startswith(('data:', '#', '/')) or re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', url):
+            return match.group(0) # Absolute and inline urls don't depend on the location of the CSS file
+        path, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+        target = posixpath.normpath(posixpath.join(css_dir, path))
+        target = manifest.get(target, target)
+        return f'url({match.group("quote")}{posixpath.relpath(target, dist_css_dir)}{suffix}{match.group("quote")})'
+    return R_CSS_URL.sub(rewrite, content.decode('utf-8')).encode('utf-8')
+
+
+def _gif_to_webp(content):
+    """Transcode an animated GIF into an animated WebP, keeping frame durations and looping"""
+    from PIL import Image # Pillow is only needed when transcoding
+    with Image.open(io.BytesIO(content)) as im:
+        out = io.BytesIO()
+        im.save(out, format='WEBP', save_all=True, quality=70, method=4)
+        return out.getvalue()
+
+
+def _write_variant(path, content, original_size):
+    """Write a compressed/transcoded variant, only if it's smaller than the original"""
+    if len(content) < original_size:
+        with open(path, 'wb') as fp:
+            fp.write(content)
+
+
+def build_assets(static_folder, transcode_gifs=False):
+    """Build fingerprinted and precompressed copies of all static files
+
+    Arguments:
+        static_folder: Path of the static folder
+        transcode_gifs: Whether to also write an animated WebP variant of each GIF
+
+    Returns:
+        dict: The manifest, mapping original file names to fingerprinted file names
+    """
+    dist_folder = os.path.join(static_folder, DIST_DIR)
+    shutil.rmtree(dist_folder, ignore_errors=True)
+    paths = []
+    for root, dirs, files in os.walk(static_folder):
+        if os.path.abspath(root) == os.path.abspath(static_folder):
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+        paths.extend(os.path.join(root, name) for name in files if not name.startswith('.')) # Skip .DS_Store
+    # CSS files last, so that the files they reference are already in the manifest
+    paths.sort(key=lambda path: os.path.splitext(path)[1].lower() == '.css')
+    manifest = {}
+    for path in paths:
+        name = os.path.basename(path)
+        rel_path = os.path.relpath(path, static_folder).replace(os.sep, '/')
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        if name.lower().endswith('.css'):
+            content = _rewrite_css_urls(rel_path, content, manifest)
+        hashed_path = _fingerprinted_name(rel_path, content)
+        out_path = os.path.join(dist_folder, hashed_path)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with open(out_path, 'wb') as fp:
+            fp.write(content)
+        ext = os.path.splitext(name)[1].lower()
+        if ext in COMPRESSIBLE_EXTENSIONS:
+            _write_variant(out_path + '.gz', gzip.compress(content, compresslevel=9, mtime=0), len(content))
+            if brotli is not None:
+                _write_variant(out_path + '.br', brotli.compress(content), len(content))
+        if transcode_gifs and ext == '.gif':
+            _write_variant(out_path + '.webp', _gif_to_webp(content), len(content))
+        manifest[rel_path] = f'{DIST_DIR}/{hashed_path}'
+    with open(os.path.join(dist_folder, MANIFEST_NAME), 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    """Load the manifest written by `build_assets`, an empty manifest is used if it wasn't built"""
+    global _manifest
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as fp:
+            _manifest = json.load(fp)
+    else:
+        _manifest = {}
+    return _manifest
+
+
+@myapp_obj.url_defaults
+def fingerprint_static_url(endpoint, values):
+    """Make `url_for('static', filename=...)` point to the fingerprinted file"""
+    if endpoint == 'static' and values.get('filename') in _manifest:
+        values['filename'] = _manifest[values['filename']]
+
+
+def send_static_asset(filename):
+    """Serve a static file, fingerprinted files are served with a one year immutable
+    `Cache-Control`, in the WebP/brotli/gzip variant accepted by the browser
+    """
+    if not filename.startswith(f'{DIST_DIR}/'):
+        return myapp_obj.send_static_file(filename)
+    static_folder = myapp_obj.static_folder
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    served, encoding = filename, None
+    candidates = []
+    if mimetype == 'image/gif' and 'image/webp' in request.accept_mimetypes.values():
+        candidates.append((filename + '.webp', 'image/webp', None))
+    if 'br' in request.accept_encodings.values():
+        candidates.append((filename + '.br', mimetype, 'br'))
+    if 'gzip' in request.accept_encodings.values():
+        candidates.append((filename + '.gz', mimetype, 'gzip'))
+    for candidate, candidate_mimetype, candidate_encoding in candidates:
+        path = safe_join(static_folder, candidate)
+        if path and os.path.isfile(path):
+            served, mimetype, encoding = candidate, candidate_mimetype, candidate_encoding
+            break
+    response = send_from_directory(static_folder, served, mimetype=mimetype, max_age=ONE_YEAR)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if filename.endswith('.gif'):
+        response.vary.add('Accept')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@myapp_obj.cli.command('build-static')
+@click.option('--transcode-gifs', is_flag=True, help='Also write animated WebP variants of GIF files (needs Pillow).')
+def build_static_command(transcode_gifs):
+    """Build fingerprinted and precompressed static files into static/dist"""
+    manifest = build_assets(myapp_obj.static_folder, transcode_gifs=transcode_gifs)
+    load_manifest(myapp_obj.static_folder)
+    click.echo(f'Built {len(manifest)} static files into {os.path.join(myapp_obj.static_folder, DIST_DIR)}')
+
+
+load_manifest(myapp_obj.static_folder)
+myapp_obj.view_functions['static'] = send_static_asset
@@ -0,0 +1,223 @@
+"""This module holds the code for online backups of the SQLite database.
+
+Backups use SQLite's online backup API, copying a few pages at a time and
+pausing in between, so requests keep reading and writing the database while
+a backup runs. The main database and every shard (see `myapp.sharding`) are
+snapshotted, shard k into `app-shard<k>-<time>.db.gz`. Every snapshot is gzip
+compressed, saved next to a `.sha256` checksum file, and only the newest
+`BACKUP_KEEP` snapshots of each database are kept:
+
+```
+cd app && FLASK_APP=run flask backup-db                  # Take one snapshot
+cd app && FLASK_APP=run flask backup-db --every 60       # Take a snapshot every 60 minutes
+cd app && FLASK_APP=run flask verify-backup <snapshot>   # Check a snapshot can be restored
+cd app && FLASK_APP=run flask verify-backup              # Check the newest snapshot of every database
+```
+
+"""
+import os
+import glob
+import gzip
+import time
+import shutil
+import sqlite3
+import hashlib
+import tempfile
+from datetime import datetime
+
+import click
+
+from myapp import myapp_obj, db
+from myapp.sharding import shard_bind_key, configured_shards
+
+SNAPSHOT_SUFFIX = '.db.gz'
+CHECKSUM_SUFFIX = '.sha256'
+
+
+class BackupError(Exception):
+    """Raised when a snapshot cannot be taken or fails verification"""
+
+
+def _database_path(shard):
+    url = db.get_engine(myapp_obj, bind=shard_bind_key(shard)).url
+    if url.get_backend_name() != 'sqlite' or not url.database:
+        raise BackupError(f'Only file based SQLite databases can be backed up, not "{url}"')
+    return url.database
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _snapshot_prefix(shard):
+    return f'app-shard{shard}-' if shard else 'app-'
+
+
+def _reserve_snapshot(backup_dir, prefix):
+    """Pick a snapshot name that no other backup uses, and create its temporary `.part` file
+
+    Returns:
+        tuple: Name and path of the snapshot, and the `.part` file opened for writing
+    """
+    while True:
+        name = prefix + datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        snapshot_path = os.path.join(backup_dir, name + SNAPSHOT_SUFFIX)
+        if os.path.exists(snapshot_path):
+            continue
+        try:
+            return name, snapshot_path, open(snapshot_path + '.part', 'xb')
+        except FileExistsError:
+            continue # Another backup picked the same name
+
+
+def backup_database(backup_dir, pages=256, step_sleep=0.005, keep=7, shard=0):
+    """Take a compressed and checksummed snapshot of a database
+
+    Arguments:
+        backup_dir: Directory to save the snapshot into
+        pages: Number of pages copied per backup step
+        step_sleep: Seconds to pause between steps, to leave the database to requests
+        keep: Number of newest snapshots to keep, older ones are deleted
+        shard: Shard to snapshot, 0 for the main database
+
+    Returns:
+        str: Path of the snapshot
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    name, snapshot_path, part = _reserve_snapshot(backup_dir, _snapshot_prefix(shard))
+    try:
+        with part, tempfile.TemporaryDirectory(dir=backup_dir) as temp_dir:
+            copy_path = os.path.join(temp_dir, name + '.db')
+            source = sqlite3.connect(_database_path(shard))
+            target = sqlite3.connect(copy_path)
+            try:
+                source.backup(target, pages=pages, progress=lambda status, remaining, total: time.sleep(step_sleep))
+            finally:
+                target.close()
+                source.close()
+            # Compress into a temporary name first, so a partial snapshot is never picked up
+            with open(copy_path, 'rb') as src, gzip.open(part, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+    except BaseException:
+        os.remove(snapshot_path + '.part')
+        raise
+    os.replace(snapshot_path + '.part', snapshot_path)
+    with open(snapshot_path + CHECKSUM_SUFFIX, 'w') as fp:
+        fp.write(f'{_sha256(snapshot_path)}  {os.path.basename(snapshot_path)}\n')
+    rotate_backups(backup_dir, keep, shard)
+    return snapshot_path
+
+
+def list_backups(backup_dir, shard=0):
+    """List snapshots of a database (shard 0 being the main database) in the backup directory, oldest first"""
+    return sorted(glob.glob(os.path.join(backup_dir, _snapshot_prefix(shard) + '[0-9]*' + SNAPSHOT_SUFFIX)))
+
+
+def rotate_backups(backup_dir, keep, shard=0):
+    """Delete all but the newest `keep` snapshots of a database
+
+    Returns:
+        list: Paths of deleted snapshots
+    """
+    deleted = list_backups(backup_dir, shard)[:-keep] if keep > 0 else []
+    for path in deleted:
+        os.remove(path)
+        if os.path.exists(path + CHECKSUM_SUFFIX):
+            os.remove(path + CHECKSUM_SUFFIX)
+    return deleted
+
+
+def verify_backup(snapshot_path):
+    """Verify that a snapshot can be restored: its checksum matches, and the
+    decompressed database opens and passes SQLite's integrity check
+
+    Arguments:
+        snapshot_path: Path of the snapshot
+
+    Returns:
+        dict: Mapping of table names to their number of rows
+
+    Raises:
+        BackupError: If the snapshot fails any of the checks
+    """
+    checksum_path = snapshot_path + CHECKSUM_SUFFIX
+    if not os.path.exists(checksum_path):
+        raise BackupError(f'Checksum file "{checksum_path}" not found')
+    with open(checksum_path) as fp:
+        expected = fp.read().split()[0]
+    if _sha256(snapshot_path) != expected:
+        raise BackupError(f'Checksum of "{snapshot_path}" does not match')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        restored_path = os.path.join(temp_dir, 'restored.db')
+        try:
+            with gzip.open(snapshot_path, 'rb') as src, open(restored_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        except (OSError, EOFError) as e:
+            raise BackupError(f'Unable to decompress "{snapshot_path}": {e}')
+        conn = sqlite3.connect(restored_path)
+        try:
+            result = conn.execute('PRAGMA integrity_check').fetchall()
+            if result != [('ok',)]:
+                raise BackupError(f'Integrity check of "{snapshot_path}" failed: {result}')
+            tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            return {table: conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0] for table in tables}
+        except sqlite3.DatabaseError as e:
+            raise BackupError(f'Unable to open "{snapshot_path}": {e}')
+        finally:
+            conn.close()
+
+
+def _backup_from_config():
+    """Snapshot the main database and every shard, returning the paths of the snapshots"""
+    config = myapp_obj.config
+    return [backup_database(config['BACKUP_DIR'], pages=config['BACKUP_PAGES_PER_STEP'],
+                            step_sleep=config['BACKUP_STEP_SLEEP'], keep=config['BACKUP_KEEP'], shard=shard)
+            for shard in configured_shards(config)]
+
+
+@myapp_obj.cli.command('backup-db')
+@click.option('--every', type=int, default=None, help='Keep running and take a snapshot every N minutes.')
+@click.option('--verify/--no-verify', default=True, help='Verify each snapshot after taking it.')
+def backup_db_command(every, verify):
+    """Take a snapshot of the database and its shards without blocking requests"""
+    while True:
+        try:
+            for path in _backup_from_config():
+                click.echo(f'Saved snapshot {path}')
+                if verify:
+                    tables = verify_backup(path)
+                    click.echo(f'Verified snapshot, {len(tables)} tables, {sum(tables.values())} rows')
+        except Exception as e:
+            if every is None:
+                raise click.ClickException(str(e)) if isinstance(e, BackupError) else e
+            # A failed snapshot (disk full, database locked...) must not stop the next ones
+            myapp_obj.logger.exception(f'Backup failed, next attempt in {every} minutes')
+        if every is None:
+            break
+        time.sleep(every * 60)
+
+
+@myapp_obj.cli.command('verify-backup')
+@click.argument('snapshot', required=False)
+def verify_backup_command(snapshot):
+    """Verify a snapshot (by default the newest one of every database) can be restored"""
+    snapshots = [snapshot]
+    if snapshot is None:
+        snapshots = []
+        for shard in configured_shards(myapp_obj.config):
+            backups = list_backups(myapp_obj.config['BACKUP_DIR'], shard)
+            if not backups:
+                raise click.ClickException(f'No snapshot found for shard {shard}' if shard else 'No snapshot found')
+            snapshots.append(backups[-1])
+    for snapshot in snapshots:
+        try:
+            tables = verify_backup(snapshot)
+        except BackupError as e:
+            raise click.ClickException(str(e))
+        for table, count in sorted(tables.items()):
+            click.echo(f'{table}: {count} rows')
+        click.echo(f'Snapshot {snapshot} is valid')
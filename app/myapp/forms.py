@@ -92,13 +92,13 @@ class ObjectiveForm(FlaskForm):
 
 
 class UploadMarkdownForm(FlaskForm):
-    """WTForm for allowing user to upload a markdown file
+    """WTForm for allowing user to upload a markdown file, or a zip archive of markdown files
     
     Attributes:
-        file: Markdown file field to select markdown file to upload
+        file: Markdown file field to select markdown file (or zip archive) to upload
         upload: Submit button to confirm upload
     """
-    file = FileField('Select markdown file:', validators=[FileRequired(), FileAllowed(['md'])])
+    file = FileField('Select markdown file or zip archive:', validators=[FileRequired(), FileAllowed(['md', 'zip'])])
     upload = SubmitField('Upload')
 
 
@@ -124,3 +124,16 @@ class ShareFlashCardForm(FlaskForm):
     share = SubmitField('Share')
 
 
+class UploadNoteForm(FlaskForm):
+    """WTForm for allowing user to upload a markdown file as a note
+
+    Attributes:
+        name: Name of the note, the file name is used if left empty
+        note: Markdown file field to select markdown file to upload
+        submit: Submit button to confirm upload
+    """
+    name = StringField('Name')
+    note = FileField('Select markdown file:', validators=[FileRequired(), FileAllowed(['md'])])
+    submit = SubmitField('Upload')
+
+
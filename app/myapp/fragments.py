@@ -0,0 +1,117 @@
+"""This module holds the template fragment cache of our app.
+
+Parts of templates that are the same for many requests can be wrapped in a
+`cache` block, keyed by a name and the values the fragment depends on. The
+fragment is rendered the first time, then served from memory (in each worker
+process) until the app is restarted, which happens on every deploy:
+
+```
+{% cache 'homepage', current_user.is_authenticated %}
+    <!-- Big block of html -->
+{% endcache %}
+```
+
+The rest of the template (like the navbar of `base.html`) is still rendered
+on every request. Least recently used fragments are evicted once the cache
+holds `FRAGMENT_CACHE_SIZE` entries, and `FRAGMENT_CACHE_SIZE = 0` disables
+the cache (useful while editing templates). Whole pages that are the same
+for every visitor can be cached with `cached_page`.
+
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request, make_response
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from myapp import myapp_obj
+
+
+class FragmentCache:
+    """Thread safe LRU cache of rendered fragments
+
+    Arguments:
+        maxsize: Number of fragments kept, 0 disables the cache
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._fragments = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        """Return the cached fragment of `key`, rendering it with `render()` if it's not cached"""
+        if self.maxsize <= 0:
+            return render()
+        with self._lock:
+            if key in self._fragments:
+                self._fragments.move_to_end(key)
+                self.hits += 1
+                return self._fragments[key]
+        value = render() # Outside of the lock, two requests may render the same fragment once
+        with self._lock:
+            self.misses += 1
+            self._fragments[key] = value
+            self._fragments.move_to_end(key)
+            while len(self._fragments) > self.maxsize:
+                self._fragments.popitem(last=False)
+        return value
+
+    def evict(self, name=None):
+        """Evict the fragments named `name` (whatever the values of their keys), or all fragments"""
+        with self._lock:
+            if name is None:
+                self._fragments.clear()
+            else:
+                for key in [key for key in self._fragments if key[0] == name]:
+                    del self._fragments[key]
+
+    def __len__(self):
+        return len(self._fragments)
+
+
+fragment_cache = FragmentCache(myapp_obj.config['FRAGMENT_CACHE_SIZE'])
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja extension adding the `{% cache name, *values %}...{% endcache %}` block"""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_cached', [nodes.List(args)]), [], [], body)\
+                    .set_lineno(lineno)
+
+    def _render_cached(self, key, caller):
+        return fragment_cache.get_or_render(tuple(key), caller)
+
+
+def cached_page(name, render):
+    """Response of a whole page from the fragment cache, with an ETag so that
+    browsers that already have it get a `304 Not Modified`. The ETag is weak,
+    as `compress_response` may gzip the body after it is set.
+    Only use it for pages that are the same for every visitor (and have no flashed messages).
+
+    Arguments:
+        name: Name of the page in the cache
+        render: Function rendering the page html
+    """
+    def render_with_etag():
+        html = render()
+        return html, hashlib.sha1(html.encode('utf-8')).hexdigest()
+    html, etag = fragment_cache.get_or_render((f'page:{name}',), render_with_etag)
+    response = make_response(html)
+    response.set_etag(etag, weak=True)
+    response.vary.add('Cookie') # Logged in users get another page at the same url
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+myapp_obj.jinja_env.add_extension(FragmentCacheExtension)
@@ -0,0 +1,257 @@
+"""This module holds the code for importing markdown flashcard files into the database.
+
+A single `.md` file is parsed in the request thread, while a `.zip` archive of
+markdown files is unpacked one member at a time, and every member is parsed by
+`myapp.mdparser.parse_markdown_file` in a process pool, so that large archives
+use all CPU cores.
+Parsed flashcards are then written into the database in batches, grouped into
+a `Deck` per file (named after its path within the archive) and a `Section`
+per <## Heading2>, while flashcards that already exist are skipped or updated
+instead of being duplicated.
+
+"""
+import os
+import zipfile
+from datetime import datetime
+from collections import namedtuple, Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from myapp import myapp_obj, db
+from myapp.models import FlashCard, Deck, Section, flashcard_hash, next_change_seq
+from myapp.mdparser import parse_markdown_file
+from myapp import stats
+
+ImportSummary = namedtuple('ImportSummary', ['added', 'updated', 'skipped'])
+
+_executor = None
+
+
+def _get_executor():
+    """Lazily create the process pool, so that it is only started in
+    the worker process that actually needs it
+    """
+    global _executor
+    if _executor is None:
+        max_workers = myapp_obj.config['IMPORT_MAX_WORKERS'] or os.cpu_count()
+        _executor = ProcessPoolExecutor(max_workers=max_workers)
+    return _executor
+
+
+def _iter_archive(stream):
+    """Iterate over the markdown files of a zip archive, reading one member at a time
+
+    Yields:
+        tuple: In the format `(filename, raw, error)`
+    """
+    max_size = myapp_obj.config['IMPORT_MAX_FILE_SIZE']
+    with zipfile.ZipFile(stream) as archive:
+        for info in archive.infolist():
+            name = info.filename
+            if info.is_dir() or not name.lower().endswith('.md'):
+                continue
+            if '__MACOSX/' in name or name.rsplit('/', 1)[-1].startswith('._'):
+                continue # Skip resource forks of archives created on macOS
+            if info.file_size > max_size:
+                yield name, None, f'file is larger than {max_size} bytes'
+                continue
+            yield name, archive.read(info), None
+
+
+def parse_markdown_archive(stream):
+    """Parse all markdown files of a zip archive in a process pool
+
+    At most twice the number of pool workers are submitted at a time,
+    so only a bounded number of files are kept in memory while unpacking.
+
+    Arguments:
+        stream: File object of a zip archive
+
+    Returns:
+        list: A list of `(filename, sections, error)` tuples, see `parse_markdown_file`
+    """
+    executor = _get_executor()
+    max_pending = 2 * (myapp_obj.config['IMPORT_MAX_WORKERS'] or os.cpu_count())
+    results = []
+    pending = []
+    for name, raw, error in _iter_archive(stream):
+        if error:
+            results.append((name, None, error))
+            continue
+        pending.append(executor.submit(parse_markdown_file, name, raw))
+        if len(pending) >= max_pending:
+            results.append(pending.pop(0).result())
+    results.extend(future.result() for future in pending)
+    return results
+
+
+def parse_upload(file_storage):
+    """Parse an uploaded `.md` or `.zip` file
+
+    Arguments:
+        file_storage: The uploaded `werkzeug.datastructures.FileStorage`
+
+    Returns:
+        list: A list of `(filename, sections, error)` tuples, see `parse_markdown_file`
+    """
+    if file_storage.filename.lower().endswith('.zip'):
+        try:
+            return parse_markdown_archive(file_storage.stream)
+        except zipfile.BadZipFile as e:
+            return [(file_storage.filename, None, str(e))]
+    return [parse_markdown_file(file_storage.filename, file_storage.stream.read())]
+
+
+def _deck_name(filename):
+    """Name a deck after the imported file, its path within an archive without
+    the `.md` extension, so that files of the same name in different directories
+    are imported into separate decks
+    """
+    name = '/'.join(part for part in filename.replace('\\', '/').split('/') if part not in ('', '.'))
+    if name.lower().endswith('.md'):
+        name = name[:-len('.md')]
+    return name
+
+
+def _get_or_create_deck(user_id, name, now):
+    """Reuse the deck of the same name, so that re-importing a file updates its deck"""
+    deck = Deck.query.filter_by(user_id=user_id, name=name).first()
+    if not deck:
+        deck = Deck(name=name, datetime=now, user_id=user_id)
+        db.session.add(deck)
+    return deck
+
+
+def _get_or_create_section(deck, name):
+    section = deck.sections.filter_by(name=name).first() if deck.id else None
+    if not section:
+        section = Section(name=name, deck=deck)
+        db.session.add(section)
+    return section
+
+
+def _backfill_hashes(user_id, batch_size):
+    """Fill in `content_hash` of flashcards saved before the column existed"""
+    query = db.session.query(FlashCard.id, FlashCard.front)\
+                .filter(FlashCard.user_id == user_id, FlashCard.content_hash == None)
+    rows = query.all()
+    for i in range(0, len(rows), batch_size):
+        db.session.bulk_update_mappings(FlashCard, [
+            dict(id=row.id, content_hash=flashcard_hash(row.front)) for row in rows[i:i+batch_size]
+        ])
+
+
+def _find_existing(deck_id, hashes, batch_size):
+    """Find existing flashcards of a deck by their `content_hash`
+
+    Returns:
+        dict: Mapping of content_hash to the list of `(id, back)` of the existing flashcards, oldest first
+    """
+    existing = defaultdict(list)
+    if deck_id is None:
+        return existing
+    hashes = list(hashes)
+    for i in range(0, len(hashes), batch_size):
+        rows = db.session.query(FlashCard.id, FlashCard.back, FlashCard.content_hash)\
+                    .filter(FlashCard.deck_id == deck_id,
+                            FlashCard.content_hash.in_(hashes[i:i+batch_size]))\
+                    .order_by(FlashCard.id).all()
+        for row in rows:
+            existing[row.content_hash].append((row.id, row.back))
+    return existing
+
+
+def _match_flashcards(imported, existing):
+    """Match the imported flashcards of one front page to the existing ones of the deck
+
+    Flashcards with the same back page are unchanged, the remaining ones update the
+    remaining existing flashcards in order, and the rest are new.
+
+    Arguments:
+        imported: List of `(section_name, flashcard)` sharing the same `content_hash`
+        existing: List of `(id, back)` of existing flashcards with that `content_hash`
+
+    Returns:
+        tuple: `(unchanged, updates, new)`, number of unchanged flashcards, list of
+        `(id, flashcard)` to update and list of `(section_name, flashcard)` to insert
+    """
+    unmatched_existing = list(existing)
+    remaining = []
+    for section_name, flashcard in imported:
+        match = next((x for x in unmatched_existing if x[1] == flashcard.back), None)
+        if match:
+            unmatched_existing.remove(match)
+        else:
+            remaining.append((section_name, flashcard))
+    updates = [(card_id, flashcard) for (card_id, _), (_, flashcard) in zip(unmatched_existing, remaining)]
+    return len(imported) - len(remaining), updates, remaining[len(updates):]
+
+
+def save_flashcards(user_id, results):
+    """Save parsed flashcards into the database in batches, within a single transaction
+
+    A `Deck` is created (or reused, by name) for every successfully parsed file, and
+    a `Section` for each of its <## Heading2>. Flashcards are matched to the existing
+    flashcards of that deck only, by `content_hash` of their front page: unchanged
+    flashcards are skipped, flashcards with a different back page are updated in place
+    (keeping their learned/view progress), and the rest are inserted. Flashcards
+    repeated with the same front and back within a deck are skipped, while the same
+    front with different back pages are kept as separate flashcards.
+
+    Arguments:
+        user_id: id of owner user of the flashcards
+        results: A list of `(filename, sections, error)` tuples, see `parse_markdown_file`
+
+    Returns:
+        ImportSummary: Number of flashcards added, updated and skipped
+    """
+    batch_size = myapp_obj.config['IMPORT_BATCH_SIZE']
+    _backfill_hashes(user_id, batch_size)
+
+    # Group parsed flashcards by deck and front page, exact duplicates are skipped
+    parsed = defaultdict(lambda: defaultdict(list)) # deck_name -> content_hash -> [(section_name, flashcard)]
+    skipped = 0
+    for filename, sections, _ in results:
+        if not sections:
+            continue
+        deck_cards = parsed[_deck_name(filename)]
+        for section_name, flashcards in sections.items():
+            for flashcard in flashcards:
+                same_front = deck_cards[flashcard_hash(flashcard.front)]
+                if any(other.back == flashcard.back for _, other in same_front):
+                    skipped += 1
+                    continue
+                same_front.append((section_name, flashcard))
+
+    inserts = []
+    updates = []
+    now = datetime.now()
+    for deck_name, deck_cards in parsed.items():
+        deck = _get_or_create_deck(user_id, deck_name, now)
+        existing = _find_existing(deck.id, deck_cards.keys(), batch_size)
+        sections = {}
+        for content_hash, imported in deck_cards.items():
+            unchanged, card_updates, new = _match_flashcards(imported, existing.get(content_hash, []))
+            skipped += unchanged
+            updates.extend(dict(id=card_id, front=flashcard.front, back=flashcard.back)
+                           for card_id, flashcard in card_updates)
+            for section_name, flashcard in new:
+                if section_name not in sections:
+                    sections[section_name] = _get_or_create_section(deck, section_name)
+                    db.session.flush() # Assign ids to deck and section
+                section = sections[section_name]
+                inserts.append(dict(front=flashcard.front, back=flashcard.back, view=0, learned=0,
+                                    user_id=user_id, deck_id=deck.id, section_id=section.id,
+                                    content_hash=content_hash))
+
+    if inserts or updates:
+        change_seq = next_change_seq(user_id) # Bulk operations skip the session events stamping flashcards
+        for row in inserts + updates:
+            row['change_seq'] = change_seq
+    for i in range(0, len(inserts), batch_size):
+        db.session.bulk_insert_mappings(FlashCard, inserts[i:i+batch_size])
+    for i in range(0, len(updates), batch_size):
+        db.session.bulk_update_mappings(FlashCard, updates[i:i+batch_size])
+    if inserts:
+        stats.record_cards_added(user_id, Counter(row['deck_id'] for row in inserts))
+    db.session.commit()
+    return ImportSummary(added=len(inserts), updated=len(updates), skipped=skipped)
@@ -3,6 +3,13 @@ from collections import namedtuple
 
 Flashcard = namedtuple('Flashcard', ['front', 'back'])
 
+# Patterns are compiled once, on import
+R_HEADER = re.compile(r'^# (?P<header1>(?:\S+(?: +\S+)*))|^## (?P<header2>(?:\S+(?: +\S+)*))', re.M)
+R_INDIVIDUAL_CARD = re.compile(r'\-{3}\n\n(?P<front>.*)\n\n\?\n\n(?P<back>.*)\n\n\-{3}')
+R_TABLE_HEADER = re.compile(r'\|[ \t]*front[ \t]*\|[ \t]*back[ \t]*(?:\||$)', re.IGNORECASE)
+R_TABLE_DELIMITER = re.compile(r'\|[ \t]*:?-{3,}:?[ \t]*\|[ \t]*:?-{3,}:?[ \t]*(?:\||$)')
+R_TABLE_CELL_SEPARATOR = re.compile(r'(?<!\\)\|')
+
 def _parse_header(data):
     """Group markdown by <# Heading1> and <# Heading2>
     while verifying that <# Heading 1> matches the string
@@ -12,9 +19,8 @@ def _parse_header(data):
     """
     header1_str = 'Markdown Flashcards'
     header1_match = False
-    r_header = re.compile(r'# (?P<header1>(?:\S+(?: +\S+)*))|## (?P<header2>(?:\S+(?: +\S+)*))')
     section_idxs = []
-    for match in r_header.finditer(data):
+    for match in R_HEADER.finditer(data):
         d = match.groupdict()
         header1 = d.get('header1')
         header2 = d.get('header2')
@@ -46,30 +52,61 @@ def _parse_individual_card_syntax(data):
     into a list of Flashcards
     """
     cards = []
-    r_ind_cards = re.compile(r'\-{3}\n\n(?P<front>.*)\n\n\?\n\n(?P<back>.*)\n\n\-{3}')
-    for match in r_ind_cards.finditer(data):
+    for match in R_INDIVIDUAL_CARD.finditer(data):
         d = match.groupdict()
-        cards.append(Flashcard(front=d.get('front'), back=d.get('back')))
+        cards.append(Flashcard(front=_unescape_side(d.get('front')), back=_unescape_side(d.get('back'))))
     return cards
 
 
+def _escape_side(text):
+    """Escape a leading `#`, so that a card side isn't parsed as a heading"""
+    return '\\' + text if text.startswith('#') else text
+
+
+def _unescape_side(text):
+    return text[1:] if text.startswith('\\#') else text
+
+
+def _split_table_row(line):
+    """Split a "| front | back |" table row into its stripped cells,
+    pipes escaped as `\\|` are kept as part of the cell
+    """
+    cells = R_TABLE_CELL_SEPARATOR.split(line[1:]) # Discard first '|' character
+    if cells[-1].strip() == '':
+        cells.pop() # Discard content after the last '|' character
+    return [cell.replace('\\|', '|').strip() for cell in cells]
+
+
 def _parse_tabular_card_syntax(data):
     """Extract all markdown content that uses tabular card syntax
     into a list of Flashcards
+
+    The content is scanned line by line, so parsing time grows linearly with
+    its size. A table starts with a "| Front | Back |" header row followed by
+    a "| --- | --- |" delimiter row, and continues until the first line that
+    isn't a table row (empty lines are allowed in between rows). Columns after
+    the back page are ignored.
     """
     cards = []
-    r_tabular = re.compile(r'\|\s*[Ff][Rr][Oo][Nn][Tt]\s*\|\s*[Bb][Aa][Cc][Kk]\s*\|\n\|\s*\-{3,}\s*\|\s*\-{3,}\s*\|\n(?P<content>(?:\|[^\|]+\|[^\|]+\|\n*)+)')
-    for match in r_tabular.finditer(data):
-        d = match.groupdict()
-        content = d.get('content')
-        if content:
-            # Decode multiple lines of "| front | back |"
-            lines = content.splitlines()
-            for line in lines:
-                line = line[1:-1] # Discard first and last '|' character
-                front, back = line.split('|')
-                # Remove leading and trailing white spaces and add card
-                cards.append(Flashcard(front=front.strip(), back=back.strip()))
+    lines = data.splitlines()
+    i = 0
+    while i < len(lines) - 1:
+        if not (R_TABLE_HEADER.match(lines[i].strip()) and R_TABLE_DELIMITER.match(lines[i+1].strip())):
+            i += 1
+            continue
+        # Decode multiple lines of "| front | back |"
+        i += 2
+        while i < len(lines):
+            line = lines[i].strip()
+            if not line:
+                i += 1
+                continue
+            if not line.startswith('|'):
+                break
+            cells = _split_table_row(line)
+            if len(cells) >= 2:
+                cards.append(Flashcard(front=cells[0], back=cells[1]))
+            i += 1
     return cards
 
 
@@ -85,8 +122,68 @@ def md2flashcard(data):
         would be their corresponding list of flashcard tuple (with front&back attributes).
     """
     sections = {}
+    data = data.replace('\r\n', '\n')
     for section_name, section_content in _parse_header(data):
         cards = _parse_individual_card_syntax(section_content)\
                 + _parse_tabular_card_syntax(section_content)
-        sections[section_name] = cards
+        sections.setdefault(section_name, []).extend(cards) # Merge sections with the same name
     return sections
+
+
+def parse_markdown_file(filename, raw):
+    """Decode and parse a single markdown file, this runs in the process pool
+    of `myapp.importer`, so it only uses this module and not the app
+
+    Arguments:
+        filename: Name of the file, only used for reporting
+        raw: Raw bytes of the file
+
+    Returns:
+        tuple: In the format `(filename, sections, error)` whereas `sections` is the
+        result of `md2flashcard` (or None on failure) and `error` is a string
+        describing why the file could not be parsed (or None on success)
+    """
+    try:
+        content = raw.decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        return filename, None, f'not a valid UTF-8 file ({e.reason} at byte {e.start})'
+    try:
+        sections = md2flashcard(content)
+    except Exception as e:
+        return filename, None, str(e)
+    if not any(sections.values()):
+        return filename, None, 'no flashcards found, file must start with "# Markdown Flashcards"'
+    return filename, sections, None
+
+
+def md_header(section_name='Flashcards'):
+    """Generate the markdown header that `md2flashcard` expects at the top of
+    a file, followed by the <## Heading2> of the first section.
+    """
+    return '# Markdown Flashcards\n\n' + md_section(section_name)
+
+
+def md_section(section_name):
+    """Generate the <## Heading2> starting a new section"""
+    section_name = ' '.join(str(section_name).split()) or 'Flashcards'
+    return f'## {section_name}\n\n'
+
+
+def flashcard2md(front, back):
+    """Generate a single card in individual card syntax, so that it could be
+    parsed back by `md2flashcard`.
+
+    The individual card syntax only allows a single line for each side,
+    so line breaks inside front/back are collapsed into spaces, and a side
+    starting with `#` is escaped as `\\#` so it isn't read as a heading.
+
+    Arguments:
+        front: Front page text
+        back: Back page text
+
+    Returns:
+        str: Markdown text of the card
+    """
+    front = _escape_side(' '.join(str(front).split()))
+    back = _escape_side(' '.join(str(back).split()))
+    return f'---\n\n{front}\n\n?\n\n{back}\n\n---\n\n'
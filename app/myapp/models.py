@@ -12,6 +12,16 @@ More detailed sqlalchemy documentations can be found [here](https://www.sqlalche
 
 """
 import os
+import re
+import html
+import hashlib
+import markdown
+from markdown import util
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+from datetime import datetime
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask import url_for
 from flask_login import UserMixin
@@ -60,7 +70,12 @@ class User(UserMixin, db.Model):
         username: String column, hold username of user, this has to be unique
         password: Hashed password of user
         avatar: Avatar image blob of user, default will be chosen if not defined
+        data_version: Integer column, incremented on every write to data of this user saved in the main database
+            (friends, sharings, notes), writes to its study data bump `StudyStats.data_version` instead
+        shard: Integer column, shard holding the flashcards, decks and statistics of this user (see `myapp.sharding`)
         flashcards: Relationship that points to all flashcards of this user
+        decks: Relationship that points to all decks of this user
+        notes: Relationship that points to all notes of this user
         friends1: Relationship that points to Friend table's user1
         friends2: Relationship that points to Friend table's user2
     """
@@ -69,7 +84,11 @@ class User(UserMixin, db.Model):
     username = db.Column(db.String(64), unique=True)
     password = db.Column(db.String(64))
     avatar = db.Column(db.LargeBinary, default=_get_default_avatar())
+    data_version = db.Column(db.Integer, default=0, nullable=False)
+    shard = db.Column(db.Integer)
     flashcards = db.relationship('FlashCard', backref='user', lazy='dynamic')
+    decks = db.relationship('Deck', backref='user', lazy='dynamic')
+    notes = db.relationship('Note', backref='user', lazy='dynamic')
     friends1 = db.relationship('Friend', backref='user1' , lazy='dynamic', foreign_keys=[Friend.user1_id])
     friends2 = db.relationship('Friend', backref='user2' , lazy='dynamic', foreign_keys=[Friend.user2_id])
 
@@ -89,6 +108,66 @@ def load_user(id):
     return User.query.get(int(id))
 
 
+class Deck(db.Model):
+    """Saves decks of flashcards, a deck is created for each imported markdown file
+
+    Attributes:
+        id: Primary key
+        name: String column, name of the deck (the path of the imported file, without `.md`)
+        datetime: Datetime column, time of creation
+        user_id: id of owner user of this deck
+        cards_total: Integer column, number of flashcards in this deck, maintained by `myapp.stats`
+        cards_mastered: Integer column, number of mastered flashcards in this deck, maintained by `myapp.stats`
+        sections: Relationship that points to all sections (<## Heading2>) of this deck
+        flashcards: Relationship that points to all flashcards of this deck
+
+    Delete decks with `myapp.models_methods.delete_deck`, which bulk deletes their sections and flashcards.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(256))
+    datetime = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    cards_total = db.Column(db.Integer, default=0, nullable=False)
+    cards_mastered = db.Column(db.Integer, default=0, nullable=False)
+    sections = db.relationship('Section', backref='deck', lazy='dynamic')
+    flashcards = db.relationship('FlashCard', backref='deck', lazy='dynamic')
+    __table_args__ = {'info': {'sharded': True}, 'sqlite_autoincrement': True}
+
+    def __repr__(self):
+        return f'<Deck {self.id}: {self.name}>'
+
+
+class Section(db.Model):
+    """Saves sections of a deck, from the <## Heading2> of imported markdown file
+
+    Attributes:
+        id: Primary key
+        name: String column, name of the section
+        deck_id: id of the deck this section belongs to
+        flashcards: Relationship that points to all flashcards of this section
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(256))
+    deck_id = db.Column(db.Integer, db.ForeignKey('deck.id'), index=True)
+    flashcards = db.relationship('FlashCard', backref='section', lazy='dynamic')
+    __table_args__ = {'info': {'sharded': True}, 'sqlite_autoincrement': True}
+
+    def __repr__(self):
+        return f'<Section {self.id}: {self.name}>'
+
+
+def flashcard_hash(front):
+    """Hash of the normalised front page text of a flashcard, whitespaces are collapsed
+    and letter case is ignored, so that re-imported cards can be matched
+    """
+    normalised = ' '.join(str(front).split()).casefold()
+    return hashlib.sha1(normalised.encode('utf-8')).hexdigest()
+
+
+def _default_flashcard_hash(context):
+    return flashcard_hash(context.get_current_parameters()['front'])
+
+
 class FlashCard(db.Model):
     """Saves FlashCards of users
 
@@ -98,6 +177,12 @@ class FlashCard(db.Model):
         back: String column, Back page text
         learned: Integer column, track how many times user learned this card
         user_id: id of owner user of this flashcard
+        deck_id: id of the deck of this flashcard, None if it was not imported
+        section_id: id of the section of this flashcard, None if it was not imported
+        content_hash: String column, `flashcard_hash` of front page text, indexed with deck_id
+        updated_at: Datetime column (UTC), time of last change
+        change_seq: Integer column, `StudyStats.data_version` of the owner when the flashcard was last changed,
+            indexed with user_id, the sync API pages changes in `(change_seq, id)` order
         sharings: relationship to a all sharing information of this flashcard
     """
     id = db.Column(db.Integer, primary_key=True)
@@ -106,12 +191,76 @@ class FlashCard(db.Model):
     view = db.Column(db.Integer)
     learned = db.Column(db.Integer)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    deck_id = db.Column(db.Integer, db.ForeignKey('deck.id'))
+    section_id = db.Column(db.Integer, db.ForeignKey('section.id'), index=True)
+    content_hash = db.Column(db.String(40), default=_default_flashcard_hash)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    change_seq = db.Column(db.Integer)
     sharings = db.relationship('SharedFlashCard', backref='flashcard', cascade='all, delete')
+    # user_id and deck_id are the first columns of these indexes, so they have no index of their own
+    __table_args__ = (db.Index('ix_flash_card_deck_id_content_hash', 'deck_id', 'content_hash'),
+                      db.Index('ix_flash_card_user_id_change_seq', 'user_id', 'change_seq'),
+                      {'info': {'sharded': True}, 'sqlite_autoincrement': True})
 
     def __repr__(self):
         return f'<FlashCard {self.id}: {self.front}, {self.back}>'
 
 
+class DeletedFlashCard(db.Model):
+    """Saves ids of deleted flashcards, so that the sync API can tell clients to delete them
+
+    Attributes:
+        id: Primary key, id of the deleted flashcard
+        user_id: id of owner user of the deleted flashcard
+        deleted_at: Datetime column (UTC), time of deletion
+        change_seq: Integer column, `StudyStats.data_version` of the owner when the flashcard was deleted,
+            indexed with user_id (see `FlashCard.change_seq`)
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    change_seq = db.Column(db.Integer)
+    __table_args__ = (db.Index('ix_deleted_flash_card_user_id_change_seq', 'user_id', 'change_seq'),
+                      {'info': {'sharded': True}})
+
+    def __repr__(self):
+        return f'<DeletedFlashCard {self.id}: {self.deleted_at}>'
+
+
+@event.listens_for(FlashCard, 'after_delete')
+def _record_deleted_flashcard(mapper, connection, target):
+    # `change_seq` is set after the flush, see `_bump_data_version_after_flush`
+    connection.execute(db.insert(DeletedFlashCard).prefix_with('OR REPLACE', dialect='sqlite')
+                          .values(id=target.id, user_id=target.user_id, deleted_at=datetime.utcnow()))
+
+
+class ReviewEvent(db.Model):
+    """Saves answers to flashcards uploaded through the sync API, the key (chosen by the client)
+    makes uploads idempotent: an event whose key was already saved is not applied again
+
+    Attributes:
+        id: Primary key
+        user_id: id of user that answered
+        key: String column, idempotency key of the event, unique per user
+        flashcard_id: Integer column, id of the answered flashcard
+        correct: Boolean column, whether the answer was correct
+        reviewed_at: Datetime column (UTC), time of the answer on the client
+        received_at: Datetime column (UTC), time the event was applied
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    key = db.Column(db.String(64), nullable=False)
+    flashcard_id = db.Column(db.Integer)
+    correct = db.Column(db.Boolean, nullable=False)
+    reviewed_at = db.Column(db.DateTime)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('user_id', 'key', name='uq_review_event_user_id_key'),
+                      {'info': {'sharded': True}, 'sqlite_autoincrement': True})
+
+    def __repr__(self):
+        return f'<ReviewEvent {self.key}: {self.flashcard_id}, {self.correct}>'
+
+
 class SharedFlashCard(db.Model):
     """Saves sharing information of flashcards
 
@@ -135,3 +284,234 @@ class SharedFlashCard(db.Model):
         return f'<{self.name}   {self.data}>'
 
 
+class _SafeUrlTreeprocessor(Treeprocessor):
+    """Remove links/images whose url uses a scheme other than http(s) or mailto (like `javascript:`)"""
+    SAFE_SCHEMES = ('http', 'https', 'mailto')
+    R_SCHEME = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.\-]*):')
+    R_IGNORED_CHARS = re.compile(r'[\x00-\x20\x7f]+') # Whitespace and control characters, dropped by browsers
+
+    @classmethod
+    def normalize_url(cls, url):
+        """Url as the browser reads it: entities (like `&#106;`) decoded, whitespace and control characters removed"""
+        return cls.R_IGNORED_CHARS.sub('', html.unescape(url.replace(util.AMP_SUBSTITUTE, '&')))
+
+    def run(self, root):
+        for element in root.iter():
+            for attribute in ('href', 'src'):
+                match = self.R_SCHEME.match(self.normalize_url(element.get(attribute, '')))
+                if match and match.group(1).lower() not in self.SAFE_SCHEMES:
+                    del element.attrib[attribute]
+
+
+class _SafeHtmlExtension(Extension):
+    """Markdown extension escaping raw html (it's shown as text) and removing unsafe urls"""
+
+    def extendMarkdown(self, md):
+        md.preprocessors.deregister('html_block')
+        md.inlinePatterns.deregister('html')
+        md.treeprocessors.register(_SafeUrlTreeprocessor(md), 'safe_url', 0)
+
+
+def render_note_html(data):
+    """Render the markdown of a note into html that is safe to show to other users"""
+    return markdown.markdown(data, extensions=[_SafeHtmlExtension()])
+
+
+class Note(db.Model):
+    """Saves markdown notes of users
+
+    The html of the note is rendered once when the markdown is saved (see `set_data`),
+    and both `data` and `html` are deferred, so listing notes doesn't load them.
+
+    Attributes:
+        id: Primary key
+        name: String column, name of the note
+        data: String column, markdown source of the note
+        html: String column, html rendered from the markdown source
+        datetime: Datetime column, time of upload
+        user_id: id of owner user of this note
+        sharings: relationship to a all sharing information of this note
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(256))
+    data = db.deferred(db.Column(db.Text))
+    html = db.deferred(db.Column(db.Text))
+    datetime = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    sharings = db.relationship('SharedNote', backref='note', cascade='all, delete')
+
+    def set_data(self, data):
+        self.data = data
+        self.html = render_note_html(data)
+
+    def __repr__(self):
+        return f'<Note {self.id}: {self.name}>'
+
+
+# Full-text index of notes, kept in sync with the note table by triggers
+for _statement in (
+    "CREATE VIRTUAL TABLE note_fts USING fts5(name, data, content='note', content_rowid='id')",
+    "CREATE TRIGGER note_fts_insert AFTER INSERT ON note BEGIN "
+        "INSERT INTO note_fts(rowid, name, data) VALUES (new.id, new.name, new.data); END",
+    "CREATE TRIGGER note_fts_delete AFTER DELETE ON note BEGIN "
+        "INSERT INTO note_fts(note_fts, rowid, name, data) VALUES ('delete', old.id, old.name, old.data); END",
+    "CREATE TRIGGER note_fts_update AFTER UPDATE ON note BEGIN "
+        "INSERT INTO note_fts(note_fts, rowid, name, data) VALUES ('delete', old.id, old.name, old.data); "
+        "INSERT INTO note_fts(rowid, name, data) VALUES (new.id, new.name, new.data); END",
+):
+    event.listen(Note.__table__, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+event.listen(Note.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS note_fts").execute_if(dialect='sqlite'))
+
+
+class SharedNote(db.Model):
+    """Saves sharing information of notes
+
+    Attributes:
+        id: Primary key
+        datetime: Datetime column, time of sharing
+        note_id: Integer column, id of note that is shared
+        owner_user_id: Integer column, id of person sharing the note
+        target_user_id: Integer column, id of person that was shared with the note
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    datetime = db.Column(db.DateTime)
+    note_id = db.Column(db.Integer, db.ForeignKey('note.id'))
+    owner_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    target_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    owner_user = db.relationship('User', foreign_keys=[owner_user_id])
+    target_user = db.relationship('User', foreign_keys=[target_user_id])
+
+    def __repr__(self):
+        return f'<SharedNote {self.id}: note {self.note_id}>'
+
+
+class StudyStats(db.Model):
+    """Saves study statistics of a user, they are updated incrementally by `myapp.stats`
+    whenever flashcards are added, removed or learned, so they can be read without
+    scanning the flashcards of the user
+
+    Attributes:
+        user_id: Primary key, id of the user of these statistics
+        cards_total: Integer column, number of flashcards of the user
+        cards_mastered: Integer column, number of flashcards learned at least `MASTERED_LEARNED_COUNT` times
+        reviewed_today: Integer column, number of answers given on `last_study_date`
+        streak_current: Integer column, number of consecutive days studied until `last_study_date`
+        streak_longest: Integer column, longest streak ever reached
+        last_study_date: Date column, last day the user answered a flashcard
+        data_version: Integer column, incremented on every write to the study data (flashcards, decks, statistics)
+            of the user, it lives in the shard of the user so that studying doesn't write to the main database
+    """
+    MASTERED_LEARNED_COUNT = 3
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    cards_total = db.Column(db.Integer, default=0, nullable=False)
+    cards_mastered = db.Column(db.Integer, default=0, nullable=False)
+    reviewed_today = db.Column(db.Integer, default=0, nullable=False)
+    streak_current = db.Column(db.Integer, default=0, nullable=False)
+    streak_longest = db.Column(db.Integer, default=0, nullable=False)
+    last_study_date = db.Column(db.Date)
+    data_version = db.Column(db.Integer, default=0, nullable=False)
+    __table_args__ = {'info': {'sharded': True}}
+
+    def __repr__(self):
+        return f'<StudyStats {self.user_id}: {self.cards_mastered}/{self.cards_total}>'
+
+
+# Columns holding the id of the user(s) that see a row, used to bump their data version
+_DATA_OWNER_COLUMNS = ('user_id', 'owner_user_id', 'target_user_id', 'user1_id', 'user2_id')
+
+
+def bump_data_version(user_ids, connection=None):
+    """Increment `User.data_version` of the specified users, after a write to their data
+    saved in the main database
+
+    This is called automatically when models are flushed, but has to be called
+    explicitly after bulk operations (`bulk_insert_mappings`, `bulk_update_mappings`),
+    which skip session events.
+
+    Arguments:
+        user_ids: ids of users whose data changed
+        connection: Connection to the main database, defaults to the one of the current session
+    """
+    user_ids = {int(x) for x in user_ids if x is not None}
+    if not user_ids:
+        return
+    statement = db.update(User)\
+                    .where(User.id.in_(user_ids))\
+                    .values(data_version=User.data_version + 1)\
+                    .execution_options(synchronize_session=False)
+    (connection or db.session.connection()).execute(statement)
+
+
+def bump_study_data_version(user_ids, connection=None):
+    """Increment `StudyStats.data_version` of the specified users, after a write to their
+    flashcards, decks or statistics. Only the shard of the users is written to.
+
+    Like `bump_data_version`, this has to be called explicitly after bulk operations.
+
+    Arguments:
+        user_ids: ids of users whose study data changed, they must all live in the shard of `connection`
+        connection: Connection to the shard of the users, defaults to the one of the current session
+    """
+    user_ids = {int(x) for x in user_ids if x is not None}
+    if not user_ids:
+        return
+    statement = sqlite_insert(StudyStats).values([dict(user_id=user_id, data_version=1) for user_id in user_ids])
+    statement = statement.on_conflict_do_update(index_elements=[StudyStats.user_id],
+                                                set_=dict(data_version=StudyStats.data_version + 1))
+    connection = connection or _study_connection()
+    connection.execute(statement)
+
+
+def _study_connection():
+    return db.session.connection(bind_arguments={'mapper': StudyStats.__mapper__})
+
+
+def next_change_seq(user_id, connection=None):
+    """Increment `StudyStats.data_version` of a user and return it, as the `change_seq` of the
+    flashcards changed by the current transaction. Use it before bulk operations, flushed models
+    are stamped automatically.
+
+    The increment locks the shard for writes until the transaction ends, so sequence
+    numbers are committed in increasing order, and clients syncing past a sequence
+    number never miss a change committed later.
+
+    Arguments:
+        user_id: id of the user whose flashcards change
+        connection: Connection to the shard of the user, defaults to the one of the current session
+
+    Returns:
+        int: The sequence number
+    """
+    connection = connection or _study_connection()
+    bump_study_data_version([user_id], connection=connection)
+    return connection.execute(db.select(StudyStats.data_version).where(StudyStats.user_id == int(user_id))).scalar()
+
+
+def _stamp_change_seq(connection, model, ids):
+    """Set `change_seq` of rows of `FlashCard` or `DeletedFlashCard` to the current data version of their owner"""
+    seq = db.select(StudyStats.data_version).where(StudyStats.user_id == model.user_id).scalar_subquery()
+    ids = list(ids)
+    for i in range(0, len(ids), 500):
+        connection.execute(db.update(model.__table__).where(model.id.in_(ids[i:i+500])).values(change_seq=seq))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _bump_data_version_after_flush(session, flush_context):
+    user_ids, study_user_ids = set(), set()
+    changed_cards, deleted_cards = set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            user_ids.add(obj.id)
+        if isinstance(obj, FlashCard):
+            (deleted_cards if obj in session.deleted else changed_cards).add(obj.id)
+        # Rows of sharded tables are all flushed to the current shard (`use_shard` flushes when switching)
+        owners = study_user_ids if obj.__table__.info.get('sharded') else user_ids
+        for column in _DATA_OWNER_COLUMNS:
+            owners.add(getattr(obj, column, None))
+    bump_data_version(user_ids, connection=session.connection())
+    if study_user_ids - {None}:
+        connection = session.connection(bind_arguments={'mapper': StudyStats.__mapper__})
+        bump_study_data_version(study_user_ids, connection=connection)
+        _stamp_change_seq(connection, FlashCard, changed_cards)
+        _stamp_change_seq(connection, DeletedFlashCard, deleted_cards)
@@ -1,4 +1,14 @@
-from myapp.models import User, FlashCard, Friend, FriendStatusEnum
+from datetime import datetime
+from collections import defaultdict
+
+import click
+from sqlalchemy.orm import undefer
+from sqlalchemy.orm.attributes import set_committed_value
+
+from myapp import myapp_obj, db
+from myapp.models import User, FlashCard, Friend, FriendStatusEnum, Note, Deck, Section, SharedFlashCard, DeletedFlashCard,\
+    render_note_html, bump_data_version, next_change_seq
+from myapp.sharding import shard_of_id, use_shard
 
 
 def get_user_from_id(user_id):
@@ -69,3 +79,121 @@ def get_all_friends(current_user_id):
             raise Exception(f"Unknown status {x.status}")
         friends.append((status, oth_user))
     return friends
+
+
+def _fts_query(text):
+    """Quote every word of the search text, so that it is matched literally
+    instead of being interpreted as FTS5 query syntax
+    """
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+def search_notes(current_user_id, text, limit=50):
+    """Function searching notes of the specified user by the full-text index
+
+    Arguments:
+        current_user_id: id of the user whose notes are searched
+        text: Search text, notes containing all of its words are found
+        limit: Maximum number of notes returned
+
+    Returns:
+        list: A list of `models.Note` objects, best match first
+    """
+    query = _fts_query(text)
+    if not query:
+        return []
+    rows = db.session.execute(db.text(
+        'SELECT note.id FROM note_fts JOIN note ON note.id = note_fts.rowid '
+        'WHERE note_fts MATCH :query AND note.user_id = :user_id ORDER BY note_fts.rank LIMIT :limit'),
+        {'query': query, 'user_id': current_user_id, 'limit': limit}
+    ).fetchall()
+    ids = [row[0] for row in rows]
+    notes = {note.id: note for note in Note.query.filter(Note.id.in_(ids))}
+    return [notes[x] for x in ids if x in notes]
+
+
+def load_shared_flashcards(sharings):
+    """Function loading the flashcards of `SharedFlashCard` records, which can live in
+    the shards of different users, with one query per shard
+
+    Arguments:
+        sharings: List of `myapp.models.SharedFlashCard`
+
+    Returns:
+        list: The same sharings, their `flashcard` is loaded (None if it no longer exists)
+    """
+    ids_by_shard = defaultdict(set)
+    for sharing in sharings:
+        ids_by_shard[shard_of_id(sharing.flashcard_id)].add(sharing.flashcard_id)
+    cards = {}
+    for shard, ids in ids_by_shard.items():
+        with use_shard(shard):
+            cards.update((card.id, card) for card in FlashCard.query.filter(FlashCard.id.in_(ids)))
+    for sharing in sharings:
+        set_committed_value(sharing, 'flashcard', cards.get(sharing.flashcard_id))
+    return sharings
+
+
+def delete_deck(deck, batch_size=500):
+    """Function deleting a deck with its sections, flashcards and their sharings,
+    with bulk statements instead of loading and deleting every flashcard
+
+    Tombstones of the deleted flashcards are saved for the sync API (like
+    `DeletedFlashCard` rows written when a single flashcard is deleted).
+    The statistics of the user are not updated, see `myapp.stats.record_cards_removed`.
+
+    Arguments:
+        deck: The `Deck` to delete, in the current shard
+        batch_size: Number of flashcard ids per statement deleting their sharings
+    """
+    user_id, deck_id = deck.user_id, deck.id
+    change_seq = next_change_seq(user_id)
+    cards = db.select(FlashCard.id, FlashCard.user_id, db.literal(datetime.utcnow()), db.literal(change_seq))\
+                .where(FlashCard.deck_id == deck_id)
+    db.session.execute(db.insert(DeletedFlashCard).prefix_with('OR REPLACE', dialect='sqlite')
+                         .from_select(['id', 'user_id', 'deleted_at', 'change_seq'], cards),
+                       bind_arguments={'mapper': DeletedFlashCard.__mapper__})
+    # Sharings are saved in the main database, which can't read the flashcards of a shard
+    card_ids = [card_id for (card_id,) in db.session.query(FlashCard.id).filter(FlashCard.deck_id == deck_id)]
+    shared_with = set()
+    for i in range(0, len(card_ids), batch_size):
+        sharings = SharedFlashCard.query.filter(SharedFlashCard.flashcard_id.in_(card_ids[i:i+batch_size]))
+        shared_with.update(target_id for (target_id,) in sharings.with_entities(SharedFlashCard.target_user_id).distinct())
+        sharings.delete(synchronize_session=False)
+    FlashCard.query.filter(FlashCard.deck_id == deck_id).delete(synchronize_session=False)
+    Section.query.filter(Section.deck_id == deck_id).delete(synchronize_session=False)
+    Deck.query.filter(Deck.id == deck_id).delete(synchronize_session=False)
+    db.session.expunge(deck)
+    if shared_with:
+        bump_data_version(shared_with | {user_id})
+
+
+def render_notes_html(batch_size=100):
+    """Function rendering again the saved html of all notes from their markdown,
+    to apply changes of `myapp.models.render_note_html` to existing notes
+
+    Returns:
+        int: Number of notes whose html changed
+    """
+    changed = 0
+    last_id = 0
+    while True:
+        notes = Note.query.options(undefer(Note.data), undefer(Note.html))\
+                    .filter(Note.id > last_id).order_by(Note.id).limit(batch_size).all()
+        if not notes:
+            break
+        for note in notes:
+            html = render_note_html(note.data or '')
+            if html != note.html:
+                note.html = html
+                changed += 1
+        last_id = notes[-1].id
+        db.session.commit()
+    return changed
+
+
+@myapp_obj.cli.command('render-notes')
+def render_notes_command():
+    """Render again the html of all notes, escaping raw html they contain"""
+    changed = render_notes_html()
+    click.echo(f'Rendered notes again, {changed} notes changed')
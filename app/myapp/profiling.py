@@ -0,0 +1,98 @@
+"""This module holds the opt-in memory profiling of requests.
+
+With `PROFILE_MEMORY = True`, `tracemalloc` traces the allocations of every
+request, and the following is recorded per endpoint (in each worker process):
+number of requests, peak memory allocated during a request, and the top
+allocation sites of the request that reached that peak. They are returned by
+`/debug/memory`, largest peak first.
+
+`MEMORY_BUDGETS` maps endpoints to the most bytes a request may allocate
+(peak), for example `{'show_flashcard': 8 * 1024 * 1024}`. A request going
+over its budget is logged with its top allocation sites, or raises
+`MemoryBudgetExceeded` when `MEMORY_BUDGET_ACTION = 'raise'`, which makes
+tests and benchmarks (see `etc/bench_memory.py`) fail.
+
+Tracing slows requests down noticeably, and allocations of concurrent
+requests are mixed, so profile with a single worker thread. Allocations made
+while a streamed response is sent (like exports) are not measured.
+
+"""
+import tracemalloc
+
+from flask import request, g, jsonify, abort
+
+from myapp import myapp_obj
+
+_endpoint_stats = {}
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a request allocates more than the budget of its endpoint"""
+
+
+def _top_sites(before, limit):
+    """Top allocation sites since the `before` snapshot, skipping tracemalloc's own allocations"""
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    after = tracemalloc.take_snapshot().filter_traces(filters)
+    return [dict(site=f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                 size_diff=stat.size_diff, count_diff=stat.count_diff)
+            for stat in after.compare_to(before.filter_traces(filters), 'lineno')[:limit]]
+
+
+def endpoint_memory_stats():
+    """Function returning the memory recorded per endpoint by this worker process
+
+    Returns:
+        dict: Mapping of endpoints to dicts with `requests`, `peak` (largest peak
+        in bytes), `last_peak` and `top` (allocation sites of the largest peak)
+    """
+    return _endpoint_stats
+
+
+def reset_memory_stats():
+    """Forget the memory recorded so far"""
+    _endpoint_stats.clear()
+
+
+@myapp_obj.before_request
+def start_memory_tracing():
+    """Reset the traced peak before each request, when `PROFILE_MEMORY` is enabled"""
+    if not myapp_obj.config['PROFILE_MEMORY']:
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(myapp_obj.config['PROFILE_MEMORY_FRAMES'])
+    g.memory_snapshot = tracemalloc.take_snapshot() if myapp_obj.config['PROFILE_MEMORY_TOP'] else None
+    tracemalloc.reset_peak()
+    g.memory_start = tracemalloc.get_traced_memory()[0]
+
+
+@myapp_obj.after_request
+def record_memory_usage(response):
+    """Record the peak memory of the request, and check it against the budget of its endpoint"""
+    if 'memory_start' not in g:
+        return response
+    peak = tracemalloc.get_traced_memory()[1] - g.memory_start
+    top = _top_sites(g.memory_snapshot, myapp_obj.config['PROFILE_MEMORY_TOP']) if g.memory_snapshot else []
+    endpoint = request.endpoint or request.path
+    stats = _endpoint_stats.setdefault(endpoint, dict(requests=0, peak=0, last_peak=0, top=[]))
+    stats['requests'] += 1
+    stats['last_peak'] = peak
+    if peak >= stats['peak']:
+        stats['peak'], stats['top'] = peak, top
+    budget = myapp_obj.config['MEMORY_BUDGETS'].get(endpoint)
+    if budget is not None and peak > budget:
+        sites = ''.join(f'\n    {site["site"]}: {site["size_diff"]} bytes' for site in top)
+        message = f'{request.method} {request.path} ({endpoint}) allocated {peak} bytes, over its budget of {budget} bytes'
+        if myapp_obj.config['MEMORY_BUDGET_ACTION'] == 'raise':
+            raise MemoryBudgetExceeded(message)
+        myapp_obj.logger.warning(message + sites)
+    return response
+
+
+@myapp_obj.route("/debug/memory")
+def show_memory_stats():
+    """Memory recorded per endpoint, only available when `PROFILE_MEMORY` is enabled"""
+    if not myapp_obj.config['PROFILE_MEMORY']:
+        abort(404)
+    endpoints = sorted(_endpoint_stats.items(), key=lambda item: item[1]['peak'], reverse=True)
+    return jsonify([dict(endpoint=endpoint, **stats) for endpoint, stats in endpoints])
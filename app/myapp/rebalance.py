@@ -0,0 +1,218 @@
+"""This module holds the tools creating the shard databases and moving users
+between shards (see `myapp.sharding`).
+
+After changing `SHARD_COUNT`, create the new shards and move every user to the
+shard it's now assigned to (`id % SHARD_COUNT`). Run it while the app is
+stopped, answers given by a user while it's being moved would be lost:
+
+```
+cd app && FLASK_APP=run flask create-shards
+cd app && FLASK_APP=run flask rebalance-shards --dry-run   # Only list the moves
+cd app && FLASK_APP=run flask rebalance-shards
+```
+
+A user is moved by copying its decks, sections, flashcards, statistics and
+review events to the target shard (flashcards get new ids from the range of
+that shard, and sharings are updated to the new ids), then switching
+`User.shard`, then deleting the rows from the source shard. These steps are separate transactions
+in separate databases, so rows left behind by an interrupted move are deleted
+by the next run of `rebalance-shards`.
+
+"""
+from datetime import datetime
+from contextlib import ExitStack
+
+import click
+
+from myapp import myapp_obj, db
+from myapp.models import User, Deck, Section, FlashCard, StudyStats, SharedFlashCard, DeletedFlashCard, ReviewEvent,\
+    bump_data_version, next_change_seq
+from myapp.sharding import SHARD_ID_SPAN, shard_bind_key, configured_shards, shard_for_new_user
+
+
+class RebalanceError(Exception):
+    """Raised when shards are not configured for the requested rebalancing"""
+
+
+def sharded_tables():
+    """List the tables saved in the shards, in dependency order"""
+    return [table for table in db.metadata.sorted_tables if table.info.get('sharded')]
+
+
+def _shard_engine(shard):
+    return db.get_engine(myapp_obj, bind=shard_bind_key(shard))
+
+
+def create_shards():
+    """Create the tables of the main database and of every configured shard.
+
+    The id sequences of shard k start at `k * SHARD_ID_SPAN`, so that ids of
+    sharded tables are unique across shards.
+    """
+    db.create_all()
+    for shard in configured_shards(myapp_obj.config)[1:]:
+        engine = _shard_engine(shard)
+        db.metadata.create_all(engine, tables=sharded_tables())
+        with engine.begin() as conn:
+            for table in sharded_tables():
+                if table.dialect_options['sqlite']['autoincrement']:
+                    conn.execute(db.text('INSERT INTO sqlite_sequence (name, seq) SELECT :name, :seq '
+                                         'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)'),
+                                 {'name': table.name, 'seq': shard * SHARD_ID_SPAN})
+
+
+def _delete_user_rows(conn, user_ids):
+    deck_ids = db.select(Deck.id).where(Deck.user_id.in_(user_ids))
+    conn.execute(db.delete(FlashCard.__table__).where(FlashCard.user_id.in_(user_ids)))
+    conn.execute(db.delete(Section.__table__).where(Section.deck_id.in_(deck_ids)))
+    conn.execute(db.delete(Deck.__table__).where(Deck.user_id.in_(user_ids)))
+    conn.execute(db.delete(StudyStats.__table__).where(StudyStats.user_id.in_(user_ids)))
+    conn.execute(db.delete(DeletedFlashCard.__table__).where(DeletedFlashCard.user_id.in_(user_ids)))
+    conn.execute(db.delete(ReviewEvent.__table__).where(ReviewEvent.user_id.in_(user_ids)))
+
+
+def _insert(conn, table, row, **values):
+    """Insert a copy of a row with a new id, returning the new id"""
+    row = dict(row, **values)
+    row.pop('id')
+    return conn.execute(db.insert(table).values(**row)).inserted_primary_key[0]
+
+
+def move_user(user_id, source, target):
+    """Move the sharded data of a user from a shard to another
+
+    Arguments:
+        user_id: id of the user
+        source: Shard currently holding the data of the user
+        target: Shard to move the data to
+
+    Returns:
+        dict: Mapping of table names to the number of rows moved
+    """
+    deck, section, card, stats = Deck.__table__, Section.__table__, FlashCard.__table__, StudyStats.__table__
+    deleted, events = DeletedFlashCard.__table__, ReviewEvent.__table__
+    with _shard_engine(source).connect() as conn:
+        decks = conn.execute(db.select(deck).where(deck.c.user_id == user_id)).mappings().all()
+        sections = conn.execute(db.select(section).where(section.c.deck_id.in_([d['id'] for d in decks])))\
+                        .mappings().all()
+        cards = conn.execute(db.select(card).where(card.c.user_id == user_id)).mappings().all()
+        stats_rows = conn.execute(db.select(stats).where(stats.c.user_id == user_id)).mappings().all()
+        deleted_rows = conn.execute(db.select(deleted).where(deleted.c.user_id == user_id)).mappings().all()
+        event_rows = conn.execute(db.select(events).where(events.c.user_id == user_id)).mappings().all()
+    now = datetime.utcnow()
+    with ExitStack() as stack:
+        # The target is committed before the directory, so a failure leaves the user on its source shard
+        directory_conn = stack.enter_context(db.engine.begin())
+        target_conn = directory_conn if target == 0 else stack.enter_context(_shard_engine(target).begin())
+        _delete_user_rows(target_conn, [user_id]) # Left by an interrupted move
+        for row in stats_rows:
+            target_conn.execute(db.insert(stats).values(**row))
+        # Copied with the data version of the user, so sync cursors stay valid in the target shard
+        change_seq = next_change_seq(user_id, connection=target_conn)
+        deck_ids = {row['id']: _insert(target_conn, deck, row) for row in decks}
+        section_ids = {row['id']: _insert(target_conn, section, row, deck_id=deck_ids[row['deck_id']])
+                       for row in sections}
+        # Flashcards get new ids, sync clients are told to replace the old ones
+        card_ids = {row['id']: _insert(target_conn, card, row, deck_id=deck_ids.get(row['deck_id']),
+                                       section_id=section_ids.get(row['section_id']), updated_at=now,
+                                       change_seq=change_seq)
+                    for row in cards}
+        for row in deleted_rows:
+            target_conn.execute(db.insert(deleted).values(**row))
+        for old_id in card_ids:
+            target_conn.execute(db.insert(deleted).values(id=old_id, user_id=user_id, deleted_at=now,
+                                                          change_seq=change_seq))
+        for row in event_rows:
+            _insert(target_conn, events, row, flashcard_id=card_ids.get(row['flashcard_id'], row['flashcard_id']))
+        if card_ids:
+            directory_conn.execute(
+                db.update(SharedFlashCard.__table__)
+                    .where(SharedFlashCard.flashcard_id == db.bindparam('old_id'))
+                    .values(flashcard_id=db.bindparam('new_id')),
+                [{'old_id': old_id, 'new_id': new_id} for old_id, new_id in card_ids.items()])
+        directory_conn.execute(db.update(User.__table__).where(User.id == user_id).values(shard=target))
+        bump_data_version([user_id], connection=directory_conn)
+    with _shard_engine(source).begin() as conn:
+        _delete_user_rows(conn, [user_id])
+    return {deck.name: len(decks), section.name: len(sections), card.name: len(cards), stats.name: len(stats_rows),
+            events.name: len(event_rows)}
+
+
+def purge_strays(shard):
+    """Delete the rows of a shard that belong to users assigned to another shard
+
+    Returns:
+        list: ids of the users whose rows were deleted
+    """
+    engine = _shard_engine(shard)
+    with engine.connect() as conn:
+        user_ids = set()
+        for table in (Deck.__table__, FlashCard.__table__, StudyStats.__table__, DeletedFlashCard.__table__,
+                      ReviewEvent.__table__):
+            user_ids.update(row[0] for row in conn.execute(db.select(table.c.user_id).distinct()))
+    user_ids.discard(None)
+    if not user_ids:
+        return []
+    with db.engine.connect() as conn:
+        strays = [row.id for row in conn.execute(db.select(User.id, User.shard).where(User.id.in_(user_ids)))
+                  if (row.shard or 0) != shard]
+    if strays:
+        with engine.begin() as conn:
+            _delete_user_rows(conn, strays)
+    return strays
+
+
+def plan_rebalance():
+    """List the users that are not in the shard they are assigned to
+
+    Returns:
+        list: Tuples `(user_id, source, target)`
+
+    Raises:
+        RebalanceError: If a shard of `SHARD_COUNT` or a source shard has no database configured
+    """
+    shard_count = myapp_obj.config['SHARD_COUNT']
+    shards = configured_shards(myapp_obj.config)
+    if shard_count > len(shards):
+        raise RebalanceError(f'SHARD_COUNT is {shard_count} but only {len(shards)} shards are configured '
+                             'in SQLALCHEMY_BINDS')
+    moves = []
+    for user_id, shard in db.session.query(User.id, User.shard).order_by(User.id):
+        source, target = shard or 0, shard_for_new_user(user_id, shard_count)
+        if source not in shards:
+            raise RebalanceError(f'Shard {source} of user {user_id} is not configured in SQLALCHEMY_BINDS')
+        if source != target:
+            moves.append((user_id, source, target))
+    return moves
+
+
+@myapp_obj.cli.command('create-shards')
+def create_shards_command():
+    """Create the tables of the main database and of every shard"""
+    create_shards()
+    click.echo(f'Created {len(configured_shards(myapp_obj.config))} shards')
+
+
+@myapp_obj.cli.command('rebalance-shards')
+@click.option('--dry-run', is_flag=True, help='Only list the users that would be moved.')
+def rebalance_shards_command(dry_run):
+    """Move every user to the shard it's assigned to with the current SHARD_COUNT"""
+    try:
+        moves = plan_rebalance()
+    except RebalanceError as e:
+        raise click.ClickException(str(e))
+    if not dry_run:
+        create_shards()
+    for user_id, source, target in moves:
+        if dry_run:
+            click.echo(f'User {user_id}: shard {source} -> {target}')
+            continue
+        counts = move_user(user_id, source, target)
+        click.echo(f'Moved user {user_id} from shard {source} to {target}: '
+                   + ', '.join(f'{count} {table}' for table, count in counts.items()))
+    if not dry_run:
+        for shard in configured_shards(myapp_obj.config):
+            strays = purge_strays(shard)
+            if strays:
+                click.echo(f'Deleted rows of users {strays} left in shard {shard}')
+    click.echo(f'{len(moves)} users {"to move" if dry_run else "moved"}')
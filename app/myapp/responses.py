@@ -0,0 +1,139 @@
+"""This module holds the code for conditional GET and compression of responses.
+
+Pages decorated with `etag_by_data_version` get a weak ETag derived from the
+data versions of current user: `User.data_version`, bumped on every write to
+their sharings and friends in the main database, and `StudyStats.data_version`,
+bumped on every write to their flashcards, decks and statistics in their shard.
+When the browser already has those versions, a `304 Not Modified` is returned
+before the view (and any of its queries) runs:
+
+```python
+@myapp_obj.route("/my-route")
+@login_required
+@etag_by_data_version
+def my_route():
+    # Code here
+    return render_template("my_route.html")
+```
+
+Pages also showing the flashcards other users shared to current user use
+`@etag_by_data_version(shared=True)`, which adds the versions of those users.
+
+Large text responses are also compressed with brotli (when the optional
+`brotli` package is installed) or gzip, depending on `Accept-Encoding`.
+
+"""
+import os
+import gzip
+import hashlib
+import functools
+
+from flask import request, session, make_response
+from flask_login import current_user
+
+from myapp import myapp_obj, db
+from myapp.models import User, StudyStats, SharedFlashCard
+from myapp.sharding import use_shard, shard_of_user
+
+try:
+    import brotli
+except ImportError: # brotli is optional, only gzip is used without it
+    brotli = None
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/csv', 'text/markdown',
+                      'application/json', 'application/javascript', 'image/svg+xml'}
+
+
+def _templates_version():
+    """Version of the templates, so that ETags change when a template is deployed.
+    This only depends on the content of the files, so it's the same in every worker process.
+    """
+    digest = hashlib.sha1()
+    template_folder = os.path.join(myapp_obj.root_path, myapp_obj.template_folder)
+    for root, dirs, files in os.walk(template_folder):
+        dirs.sort()
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as fp:
+                digest.update(fp.read())
+    return digest.hexdigest()[:12]
+
+
+TEMPLATES_VERSION = _templates_version()
+
+
+def _study_data_versions(user_ids):
+    """`StudyStats.data_version` of the specified users, read from the shard of each user"""
+    shards = {}
+    for user in User.query.filter(User.id.in_(user_ids)).with_entities(User.id, User.shard):
+        shards.setdefault(shard_of_user(user), []).append(user.id)
+    versions = {}
+    for shard, shard_user_ids in shards.items():
+        with use_shard(shard):
+            versions.update(db.session.query(StudyStats.user_id, StudyStats.data_version)
+                              .filter(StudyStats.user_id.in_(shard_user_ids)))
+    return sorted(versions.items())
+
+
+def _data_version_key(shared):
+    """Versions of the data shown to current user, see the module documentation"""
+    user_ids = {current_user.id}
+    if shared:
+        user_ids.update(owner_id for (owner_id,) in db.session.query(SharedFlashCard.owner_user_id)
+                                                       .filter_by(target_user_id=current_user.id).distinct())
+    return f'{current_user.data_version}:{current_user.shard}:{_study_data_versions(user_ids)}'
+
+
+def etag_by_data_version(view=None, shared=False):
+    """Decorator returning `304 Not Modified` for GET requests when the browser
+    has the page of the current data versions, otherwise the weak ETag
+    is added to the response of the view.
+
+    Pages rendering flashed messages are skipped, as they differ between visits.
+    Only use it on pages that depend on nothing but the data of current user
+    (and with `shared=True`, the flashcards shared to current user).
+    """
+    if view is None:
+        return functools.partial(etag_by_data_version, shared=shared)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+            return view(*args, **kwargs)
+        key = f'{request.full_path}:{current_user.id}:{_data_version_key(shared)}:{TEMPLATES_VERSION}'
+        etag = hashlib.sha1(key.encode()).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return wrapper
+
+
+@myapp_obj.after_request
+def compress_response(response):
+    """Compress large text responses with brotli or gzip, if the browser accepts it"""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        encoding, compress = 'br', brotli.compress
+    elif accepted['gzip']:
+        encoding, compress = 'gzip', functools.partial(gzip.compress, compresslevel=6)
+    else:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    response.set_data(compress(data))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -24,24 +24,33 @@ Detailed flask documentation can be found [here](https://flask.palletsprojects.c
 """
 
 import os
+import io
+import csv
+import json
 import tempfile
 import random
 import pathlib
 from datetime import datetime
 import markdown
 from base64 import b64encode
-from flask import render_template, flash, redirect, url_for, request, jsonify, abort, send_file
+from flask import render_template, flash, redirect, url_for, request, jsonify, abort, send_file, Response, stream_with_context, session
 from werkzeug.security import generate_password_hash
 from flask_login import current_user, login_user, logout_user, login_required
 from xhtml2pdf import pisa
 from werkzeug.utils import secure_filename
+from sqlalchemy.orm import undefer
 
 
 from myapp import myapp_obj, db
-from myapp.forms import SignupForm, LoginForm, FlashCardForm, UploadMarkdownForm, SearchForm, ShareFlashCardForm, NextButton, ObjectiveForm
-from myapp.models import User, FlashCard, Friend, FriendStatusEnum, SharedFlashCard
-from myapp.models_methods import get_friend_status, get_all_friends
-from myapp.mdparser import md2flashcard
+from myapp.forms import SignupForm, LoginForm, FlashCardForm, UploadMarkdownForm, SearchForm, ShareFlashCardForm, NextButton, ObjectiveForm, UploadNoteForm
+from myapp.models import User, FlashCard, Friend, FriendStatusEnum, SharedFlashCard, Deck, Note, SharedNote, bump_data_version
+from myapp.models_methods import get_friend_status, get_all_friends, search_notes, load_shared_flashcards, delete_deck
+from myapp.mdparser import md_header, md_section, flashcard2md
+from myapp.importer import parse_upload, save_flashcards
+from myapp.responses import etag_by_data_version
+from myapp.sharding import shard_for_new_user
+from myapp.fragments import cached_page
+from myapp import stats
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -54,7 +63,9 @@ def jinja_encode_to_b64():
 
 @myapp_obj.route("/")
 def home():
-    """Homepage route"""
+    """Homepage route, the same page is served to every anonymous visitor from the cache"""
+    if not current_user.is_authenticated and not session.get('_flashes'):
+        return cached_page('home', lambda: render_template("homepage.html"))
     return render_template("homepage.html")
 
 
@@ -68,6 +79,8 @@ def signup():
         hashed_password = generate_password_hash(form.password.data)
         user = User(email=form.email.data, username=form.username.data, password=hashed_password)
         db.session.add(user)
+        db.session.flush() # Get the id, to assign the shard
+        user.shard = shard_for_new_user(user.id, myapp_obj.config['SHARD_COUNT'])
         db.session.commit()
         flash("Your account has been created. You can now login")
         return redirect(url_for("home"))
@@ -150,21 +163,80 @@ def add_flashcard():
     if form.validate_on_submit():
         card = FlashCard(front=form.front.data, back=form.back.data, view=0, learned=0, user=current_user._get_current_object())
         db.session.add(card)
+        stats.record_cards_added(current_user.get_id(), total=1)
         db.session.commit()
         flash("Flashcard has been created", "success")
         return redirect(url_for("add_flashcard"))
     return render_template("/add-flashcard.html", form=form)
 
 
+def _get_deck(deck_id):
+    """Get a deck of current user, abort if it doesn't exists or belongs to other user"""
+    deck = Deck.query.filter_by(id=deck_id, user_id=current_user.get_id()).one_or_none()
+    if not deck:
+        abort(404, description=f'Unable to find deck with id {deck_id}')
+    return deck
+
+
+def _query_flashcards(deck_id=None):
+    """Query flashcards of current user, only within the specified deck if `deck_id` is given"""
+    if deck_id is None:
+        return FlashCard.query.filter_by(user_id=current_user.get_id())
+    return FlashCard.query.filter_by(deck_id=_get_deck(deck_id).id)
+
+
+@myapp_obj.route("/my-decks")
+@login_required
+@etag_by_data_version
+def show_decks():
+    """My Decks route, to show all decks of current user with their number of flashcards"""
+    decks = Deck.query.filter_by(user_id=current_user.get_id()).order_by(Deck.name).all()
+    return render_template("my-decks.html", decks=decks)
+
+
+@myapp_obj.route("/remove-deck/<int:deck_id>", methods=['GET', 'POST'])
+@login_required
+def remove_deck(deck_id):
+    """A route to remove a deck together with all of its flashcards,
+    this will redirect back to My Decks after removing the specified deck
+    """
+    deck = _get_deck(deck_id)
+    flash(f'Deleted deck "{deck.name}" and its flashcards')
+    stats.record_cards_removed(deck.user_id, deck.flashcards.with_entities(FlashCard.deck_id, FlashCard.learned))
+    delete_deck(deck)
+    db.session.commit()
+    return redirect(url_for("show_decks"))
+
+
 @myapp_obj.route("/my-flashcards")
+@myapp_obj.route("/my-flashcards/deck/<int:deck_id>")
 @login_required
-def show_flashcard():
-    """My Flashcard route, to show all flashcard of current user by order based on how often user got answer correct"""
-    ordered_cards = FlashCard.query.filter_by(user_id=current_user.get_id()).order_by(FlashCard.learned).all()
+@etag_by_data_version
+def show_flashcard(deck_id=None):
+    """My Flashcard route, to show all flashcard of current user (or of one of its decks)
+    by order based on how often user got answer correct
+    """
+    deck = _get_deck(deck_id) if deck_id is not None else None
+    ordered_cards = _query_flashcards(deck_id).order_by(FlashCard.learned).all()
     if not ordered_cards:
         flash("You don't have any flashcards. Please create one", "warning")
         return redirect(url_for("add_flashcard"))
-    return render_template("my-flashcards.html", ordered_cards=ordered_cards)
+    return render_template("my-flashcards.html", ordered_cards=ordered_cards, deck=deck)
+
+
+@myapp_obj.route("/my-stats")
+@login_required
+def show_stats():
+    """My Progress route, to show study statistics of current user"""
+    return render_template("stats.html", stats=stats.get_stats(current_user.get_id()),
+                           mastered_learned_count=stats.MASTERED)
+
+
+@myapp_obj.route("/api/stats")
+@login_required
+def api_stats():
+    """Study statistics of current user as json"""
+    return jsonify(stats.get_stats(current_user.get_id()))
 
 
 def _shuffle_choices(current_card, cards):
@@ -185,27 +257,32 @@ def _shuffle_choices(current_card, cards):
 @myapp_obj.route("/import-flashcard", methods=['GET', 'POST'])
 @login_required
 def import_flashcard():
-    """Import Flashcard route, for user to import markdown file into flashcard"""
+    """Import Flashcard route, for user to import markdown file (or zip archive of markdown files) into flashcard"""
     form = UploadMarkdownForm()
     if form.validate_on_submit():
         f = form.file.data
-        content = f.stream.read().decode('ascii')
-        for section, flashcards in md2flashcard(content).items(): # TODO: Save flashcard by section
-            for flashcard in flashcards:
-                card = FlashCard(front=flashcard.front, back=flashcard.back, learned=0,  user=current_user._get_current_object())
-                db.session.add(card)
-        db.session.commit()
-        flash(f'Uploaded file {f.filename} into flashcards')
+        results = parse_upload(f)
+        for filename, _, error in results:
+            if error:
+                flash(f'Unable to import "{filename}": {error}', "error")
+        summary = save_flashcards(current_user.get_id(), results)
+        imported = sum(1 for _, _, error in results if not error)
+        flash(f'Uploaded file {f.filename}, imported {imported} of {len(results)} files: '
+              f'{summary.added} flashcards added, {summary.updated} updated, {summary.skipped} skipped')
         return redirect(url_for("show_flashcard"))
     return render_template("import-flashcard.html", form=form)
 
 
 @myapp_obj.route("/learn-flashcard", methods=['GET', 'POST'])
+@myapp_obj.route("/learn-flashcard/deck/<int:deck_id>", methods=['GET', 'POST'])
 @login_required
-def learn_flashcard():
-    """Learn Flashcard route, for user to learn from all it's existing flashcards in My Flashcards"""
-    first_card = FlashCard.query.filter_by(user_id=current_user.get_id()).order_by(FlashCard.learned, FlashCard.view).first()
-    cards = FlashCard.query.filter_by(user_id=current_user.get_id()).all() # list of cards that the current user has
+def learn_flashcard(deck_id=None):
+    """Learn Flashcard route, for user to learn from all it's existing flashcards in My Flashcards,
+    or only from the flashcards of the specified deck
+    """
+    query = _query_flashcards(deck_id)
+    first_card = query.order_by(FlashCard.learned, FlashCard.view).first()
+    cards = query.with_entities(FlashCard.id).all() # list of ids of cards that the current user has
 
     if len(cards) < 4:
         flash("You must have at least 4 flashcards. Please create more flashcards", "warning")
@@ -245,27 +322,31 @@ def learn_flashcard():
                 flash('Excellent', "success")
                 correct_choice = first_card.back # Pass this to html template so it will render this as card instead of ABCD options
                 first_card.learned += 1
+                stats.record_review(first_card, correct=True)
                 db.session.commit()
             else:
                 flash('opps. Wrong answer', "error")
+                stats.record_review(first_card, correct=False)
+                db.session.commit()
     else:
         if formNext.validate_on_submit():
             first_card.view += 1
             db.session.commit()
-            return redirect(url_for("learn_flashcard"))
+            return redirect(url_for("learn_flashcard", deck_id=deck_id))
 
     form.A.label.text = choice[0].back
     form.B.label.text = choice[1].back
     form.C.label.text = choice[2].back
     form.D.label.text = choice[3].back
-    return render_template("learn-flashcard.html", first_card=first_card, form=form, formNext=formNext, choice=choice, list_id=list_id, correct_choice=correct_choice)
+    return render_template("learn-flashcard.html", first_card=first_card, form=form, formNext=formNext, choice=choice, list_id=list_id, correct_choice=correct_choice, deck_id=deck_id)
 
 
 @myapp_obj.route("/download-flashcard-as-pdf", methods=['GET', 'POST'])
+@myapp_obj.route("/download-flashcard-as-pdf/deck/<int:deck_id>", methods=['GET', 'POST'])
 @login_required
-def download_flashcard_as_pdf():
-    """Download Flashcards to a single PDF file, then it will redirect user back to My Flashcards"""
-    ordered_cards = FlashCard.query.filter_by(user_id=current_user.get_id()).order_by(FlashCard.learned).all()
+def download_flashcard_as_pdf(deck_id=None):
+    """Download Flashcards (of all or of one deck) to a single PDF file, then it will redirect user back to My Flashcards"""
+    ordered_cards = _query_flashcards(deck_id).order_by(FlashCard.learned).all()
     # Handle case of no flashcard
     if not ordered_cards:
         abort(404, description="No flashcards found, cannot download as pdf")
@@ -282,9 +363,100 @@ def download_flashcard_as_pdf():
         # Convert html to pdf
         with open(pdf_filename, "wb+") as fp:
             pisa_status = pisa.CreatePDF(html, dest=fp)
+        if pisa_status.err:
+            abort(500, description='Unable to convert flashcards to pdf')
         return send_file(pdf_filename, as_attachment=True)
 
 
+EXPORT_BATCH_SIZE = 500
+
+
+def _iter_flashcards(query):
+    """Iterate over flashcards of a query ordered by section, in batches of `EXPORT_BATCH_SIZE` rows,
+    so that only one batch is held in memory at a time
+
+    Each batch is a short keyset query that is fully fetched before its flashcards are
+    yielded, so no database cursor (and SQLite lock) stays open while the client reads.
+    """
+    section_key = db.func.coalesce(FlashCard.section_id, 0) # Flashcards without a section come first
+    last_key = None
+    while True:
+        batch_query = query
+        if last_key is not None:
+            batch_query = batch_query.filter(db.tuple_(section_key, FlashCard.id) > db.tuple_(*last_key))
+        batch = batch_query.order_by(section_key, FlashCard.id).limit(EXPORT_BATCH_SIZE).all()
+        if not batch:
+            return
+        last_key = (batch[-1].section_id or 0, batch[-1].id)
+        yield from batch
+
+
+def _export_markdown(cards):
+    """Generate markdown export in the syntax that `md2flashcard` reads,
+    flashcards imported from a section are written back under their <## Heading2>
+    """
+    header_written = False
+    section_id = None
+    for card in cards:
+        section_name = card.section.name if card.section else 'Flashcards'
+        if not header_written:
+            header_written = True
+            section_id = card.section_id
+            yield md_header(section_name)
+        elif card.section_id != section_id:
+            section_id = card.section_id
+            yield md_section(section_name)
+        yield flashcard2md(card.front, card.back)
+    if not header_written:
+        yield md_header()
+
+
+def _export_csv(cards):
+    """Generate csv export with a header row of `front,back,learned,view`"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['front', 'back', 'learned', 'view'])
+    for card in cards:
+        writer.writerow([card.front, card.back, card.learned, card.view])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+    yield buffer.getvalue() # Header only, if there's no flashcard
+
+
+def _export_ndjson(cards):
+    """Generate newline delimited json export, one flashcard object per line"""
+    for card in cards:
+        yield json.dumps({'id': card.id, 'front': card.front, 'back': card.back,
+                          'learned': card.learned, 'view': card.view}) + '\n'
+
+
+EXPORT_FORMATS = {
+    # format: (generator, mimetype, file extension)
+    'md': (_export_markdown, 'text/markdown', 'md'),
+    'csv': (_export_csv, 'text/csv', 'csv'),
+    'ndjson': (_export_ndjson, 'application/x-ndjson', 'ndjson'),
+}
+
+
+@myapp_obj.route("/export-flashcard/<string:fmt>")
+@myapp_obj.route("/export-flashcard/<string:fmt>/deck/<int:deck_id>")
+@login_required
+def export_flashcard(fmt, deck_id=None):
+    """Export all flashcards of current user (or of one of its decks) as a streamed file download,
+    `fmt` can be either 'md', 'csv' or 'ndjson'.
+    """
+    if fmt not in EXPORT_FORMATS:
+        abort(404, description=f'Unknown export format "{fmt}"')
+    generate, mimetype, extension = EXPORT_FORMATS[fmt]
+    filename = 'flashcards'
+    if deck_id is not None:
+        filename = secure_filename(_get_deck(deck_id).name) or filename
+    cards = _iter_flashcards(_query_flashcards(deck_id))
+    headers = {'Content-Disposition': f'attachment; filename={filename}.{extension}'}
+    return Response(stream_with_context(generate(cards)), mimetype=mimetype, headers=headers)
+
+
 @myapp_obj.route("/remove-flashcard/<int:flashcard_id>", methods=['GET', 'POST'])
 @login_required
 def remove_flashcard(flashcard_id):
@@ -294,6 +466,7 @@ def remove_flashcard(flashcard_id):
     flashcard = FlashCard.query.filter_by(id=flashcard_id).one_or_none()
     if flashcard:
         flash(f'Deleted flashcard front="{flashcard.front}", back="{flashcard.back}"')
+        stats.record_cards_removed(flashcard.user_id, [(flashcard.deck_id, flashcard.learned)])
         db.session.delete(flashcard)
         db.session.commit()
     return redirect(url_for("show_flashcard"))
@@ -328,12 +501,42 @@ def share_flashcard(flashcard_id):
     return render_template("share-flashcard.html", flashcard=flashcard, form=form)
 
 
+@myapp_obj.route("/share-deck/<int:deck_id>", methods=['GET', 'POST'])
+@login_required
+def share_deck(deck_id):
+    """A route for user to use the ShareFlashCardForm to select which friend they
+    want to share all flashcards of the specified deck with.
+    """
+    deck = _get_deck(deck_id)
+    friends = []
+    for status, oth_user in get_all_friends(current_user.get_id()):
+        if status == 'friend': # Only find friends
+            friends.append(oth_user)
+    form = ShareFlashCardForm()
+    form.dropdown.choices = [(u.id, u.username) for u in friends]
+    if form.validate_on_submit():
+        user = User.query.filter_by(id=form.dropdown.data).one()
+        now = datetime.now()
+        flashcard_ids = [x.id for x in deck.flashcards.with_entities(FlashCard.id)]
+        db.session.bulk_insert_mappings(SharedFlashCard, [
+            dict(flashcard_id=flashcard_id, datetime=now,
+                 owner_user_id=current_user.get_id(), target_user_id=user.id)
+            for flashcard_id in flashcard_ids
+        ])
+        bump_data_version([current_user.get_id(), user.id])
+        db.session.commit()
+        flash(f'Shared deck "{deck.name}" ({len(flashcard_ids)} flashcards) to "{user.username}" on {str(now)}')
+        return redirect(url_for("show_decks"))
+    return render_template("share-deck.html", deck=deck, form=form)
+
+
 @myapp_obj.route("/flashcards-sharing", methods=['GET', 'POST'])
 @login_required
+@etag_by_data_version(shared=True)
 def flashcards_sharing():
     """A route for viewing sharing status of flashcards (both shared to others and others shared to me)"""
-    owner_flashcards = SharedFlashCard.query.filter_by(owner_user_id=current_user.get_id()).all()
-    target_flashcards = SharedFlashCard.query.filter_by(target_user_id=current_user.get_id()).all()
+    owner_flashcards = load_shared_flashcards(SharedFlashCard.query.filter_by(owner_user_id=current_user.get_id()).all())
+    target_flashcards = load_shared_flashcards(SharedFlashCard.query.filter_by(target_user_id=current_user.get_id()).all())
     return render_template("flashcards-sharing.html", owner_flashcards=owner_flashcards, target_flashcards=target_flashcards)
 
 
@@ -345,10 +548,12 @@ def flashcards_sharing_add_to_myflashcards(sharing_id):
     if int(current_user.get_id()) != sharing.owner_user_id and\
         int(current_user.get_id()) != sharing.target_user_id:
         abort(404, description='Invalid permission')
+    load_shared_flashcards([sharing])
     card = FlashCard(front=sharing.flashcard.front, back=sharing.flashcard.back, learned=0, user=current_user._get_current_object())
     db.session.add(card)
+    stats.record_cards_added(current_user.get_id(), total=1)
     db.session.commit()
-    flash(f'Copied flashcard(#{sharing.flashcard.id}) to "My Flashcards", new flashcard(#{card.id})')
+    flash(f'Copied flashcard(#{sharing.flashcard_id}) to "My Flashcards", new flashcard(#{card.id})')
     return redirect(url_for('flashcards_sharing'))
 
 
@@ -360,12 +565,164 @@ def flashcards_sharing_cancel_sharing(sharing_id):
     if int(current_user.get_id()) != sharing.owner_user_id and\
         int(current_user.get_id()) != sharing.target_user_id:
         abort(404, description='Invalid permission')
-    flash(f'Sharing of flashcard(#{sharing.flashcard.id}) cancelled')
+    flash(f'Sharing of flashcard(#{sharing.flashcard_id}) cancelled')
     db.session.delete(sharing)
     db.session.commit()
     return redirect(url_for('flashcards_sharing'))
 
 
+# Notes
+NOTES_PER_PAGE = 20
+
+
+def _get_note(note_id):
+    """Get a note of current user, abort if it doesn't exists or belongs to other user"""
+    note = Note.query.filter_by(id=note_id, user_id=current_user.get_id()).one_or_none()
+    if not note:
+        abort(404, description=f'Unable to find note with id {note_id}')
+    return note
+
+
+@myapp_obj.route("/note", methods=['GET', 'POST'])
+@myapp_obj.route("/viewNote/<int:note_id>", methods=['GET', 'POST'])
+@login_required
+def show_notes(note_id=None):
+    """My Notes route, to show a page of notes of current user (or the notes matching the search text),
+    and the rendered html of the specified note
+    """
+    note = None
+    if note_id is not None:
+        note = Note.query.options(undefer(Note.html)).filter_by(id=note_id, user_id=current_user.get_id()).one_or_none()
+        if not note:
+            abort(404, description=f'Unable to find note with id {note_id}')
+    search_form = SearchForm()
+    pagination = None
+    if search_form.validate_on_submit() and search_form.text.data:
+        posted_notes = search_notes(current_user.get_id(), search_form.text.data)
+    else:
+        page = request.args.get('page', 1, type=int)
+        pagination = Note.query.filter_by(user_id=current_user.get_id()).order_by(Note.id.desc())\
+                        .paginate(page=page, per_page=NOTES_PER_PAGE, error_out=False)
+        posted_notes = pagination.items
+    return render_template("note.html", posted_notes=posted_notes, pagination=pagination, search_form=search_form,
+                           note=note, html_text=note.html if note else None)
+
+
+@myapp_obj.route("/upload-note", methods=['GET', 'POST'])
+@login_required
+def upload_note():
+    """Upload Note route, for user to upload a markdown file as a note,
+    the html of the note is rendered once here
+    """
+    form = UploadNoteForm()
+    if form.validate_on_submit():
+        f = form.note.data
+        try:
+            data = f.stream.read().decode('utf-8-sig').replace('\r\n', '\n')
+        except UnicodeDecodeError:
+            flash(f'Unable to upload "{f.filename}": not a valid UTF-8 file', "error")
+            return redirect(url_for("upload_note"))
+        name = form.name.data or pathlib.Path(f.filename).stem
+        note = Note(name=name, datetime=datetime.now(), user_id=current_user.get_id())
+        note.set_data(data)
+        db.session.add(note)
+        db.session.commit()
+        flash(f'Uploaded note "{name}"')
+        return redirect(url_for("show_notes", note_id=note.id))
+    return render_template("upload-note.html", form=form)
+
+
+@myapp_obj.route("/remove-note/<int:note_id>", methods=['GET', 'POST'])
+@login_required
+def remove_note(note_id):
+    """A route to remove a note, this will redirect back to My Notes after removing it"""
+    note = _get_note(note_id)
+    flash(f'Deleted note "{note.name}"')
+    db.session.delete(note)
+    db.session.commit()
+    return redirect(url_for("show_notes"))
+
+
+@myapp_obj.route("/download-note-as-pdf/<int:note_id>", methods=['GET', 'POST'])
+@login_required
+def download_note_as_pdf(note_id):
+    """Download a note as PDF file, converted from its pre-rendered html"""
+    note = _get_note(note_id)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_filename = os.path.join(temp_dir, f'{secure_filename(note.name) or "note"}.pdf')
+        # Convert html to pdf
+        with open(pdf_filename, "wb+") as fp:
+            pisa_status = pisa.CreatePDF(note.html, dest=fp)
+        if pisa_status.err:
+            abort(500, description=f'Unable to convert note with id {note_id} to pdf')
+        return send_file(pdf_filename, as_attachment=True)
+
+
+@myapp_obj.route("/share-notes/<int:note_id>", methods=['GET', 'POST'])
+@login_required
+def share_note(note_id):
+    """A route for user to use the ShareFlashCardForm to select which friend they
+    want to share the specified note with.
+    """
+    note = _get_note(note_id)
+    friends = []
+    for status, oth_user in get_all_friends(current_user.get_id()):
+        if status == 'friend': # Only find friends
+            friends.append(oth_user)
+    form = ShareFlashCardForm()
+    form.dropdown.choices = [(u.id, u.username) for u in friends]
+    if form.validate_on_submit():
+        user = User.query.filter_by(id=form.dropdown.data).one()
+        now = datetime.now()
+        share_note = SharedNote(note_id=note_id,
+                                datetime=now,
+                                owner_user_id=current_user.get_id(),
+                                target_user_id=user.id)
+        db.session.add(share_note)
+        db.session.commit()
+        flash(f'Shared note "{note.name}" to "{user.username}" on {str(now)}')
+        return redirect(url_for("show_notes"))
+    return render_template("share-notes.html", note=note, form=form)
+
+
+@myapp_obj.route("/notes-sharing", methods=['GET', 'POST'])
+@login_required
+def notes_sharing():
+    """A route for viewing sharing status of notes (both shared to others and others shared to me)"""
+    owner_notes = SharedNote.query.filter_by(owner_user_id=current_user.get_id()).all()
+    target_notes = SharedNote.query.filter_by(target_user_id=current_user.get_id()).all()
+    return render_template("notes-sharing.html", owner_notes=owner_notes, target_notes=target_notes)
+
+
+@myapp_obj.route("/notes-sharing/add-to-mynotes/<int:sharing_id>", methods=['GET', 'POST'])
+@login_required
+def notes_sharing_add_to_mynotes(sharing_id):
+    """A route for adding shared note that other user shared into My Notes"""
+    sharing = SharedNote.query.get_or_404(sharing_id)
+    if int(current_user.get_id()) != sharing.target_user_id:
+        abort(404, description='Invalid permission')
+    shared = Note.query.options(undefer(Note.data), undefer(Note.html)).filter_by(id=sharing.note_id).one()
+    note = Note(name=shared.name, data=shared.data, html=shared.html, datetime=datetime.now(), user_id=current_user.get_id())
+    db.session.add(note)
+    db.session.commit()
+    flash(f'Copied note "{shared.name}" to "My Notes"')
+    return redirect(url_for('notes_sharing'))
+
+
+@myapp_obj.route("/notes-sharing/cancel-sharing/<int:sharing_id>", methods=['GET', 'POST'])
+@login_required
+def notes_sharing_cancel_sharing(sharing_id):
+    """A route for cancelling a note sharing"""
+    sharing = SharedNote.query.get_or_404(sharing_id)
+    if int(current_user.get_id()) != sharing.owner_user_id and\
+        int(current_user.get_id()) != sharing.target_user_id:
+        abort(404, description='Invalid permission')
+    flash(f'Sharing of note "{sharing.note.name}" cancelled')
+    db.session.delete(sharing)
+    db.session.commit()
+    return redirect(url_for('notes_sharing'))
+
+
 # Friends
 @myapp_obj.route("/my-friends", methods=['GET', 'POST'])
 @login_required
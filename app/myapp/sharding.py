@@ -0,0 +1,128 @@
+"""This module holds the session layer that shards the study data of users
+(flashcards, decks, sections and study statistics) across `SHARD_COUNT`
+SQLite databases, while users, friends, notes and sharing metadata stay in
+the main (directory) database.
+
+Shard 0 is the main database itself, shard `k > 0` is the bind `shard<k>`.
+Each user is assigned to a shard (`User.shard`), and queries/writes of the
+sharded models are routed to the shard of current user, or to the shard
+selected explicitly with:
+
+```python
+with use_shard(shard):
+    cards = FlashCard.query.filter(...).all()
+```
+
+Ids of sharded tables are allocated from a separate range in every shard
+(see `SHARD_ID_SPAN`), so they are unique across shards and the shard of a
+row can be told from its id, which is how sharings of flashcards are read
+across shards. With the default `SHARD_COUNT = 1` everything lives in the
+main database as before.
+
+"""
+import os
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import current_app, has_app_context, has_request_context
+from flask_login import current_user
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import orm
+
+# Ids of sharded tables in shard k start at k * SHARD_ID_SPAN
+SHARD_ID_SPAN = 10 ** 12
+
+_selected_shard = ContextVar('selected_shard', default=None)
+
+
+def shard_bind_key(shard):
+    """Bind key of a shard, None for shard 0 which is the main database"""
+    return f'shard{shard}' if shard else None
+
+
+def shard_binds(basedir, shard_count):
+    """Build `SQLALCHEMY_BINDS` for shards 1 to `shard_count - 1`
+
+    When lowering `SHARD_COUNT`, keep building the binds with the old count
+    until `flask rebalance-shards` moved the users out of the removed shards.
+    """
+    return {shard_bind_key(k): 'sqlite:///' + os.path.join(basedir, f'app-shard{k}.db')
+            for k in range(1, shard_count)}
+
+
+def configured_shards(config):
+    """List the shards that have a database configured"""
+    bind_keys = config.get('SQLALCHEMY_BINDS') or {}
+    count = 1
+    while shard_bind_key(count) in bind_keys:
+        count += 1
+    return list(range(count))
+
+
+def shard_of_id(row_id):
+    """Shard holding a row of a sharded table, told from its id"""
+    return int(row_id) // SHARD_ID_SPAN
+
+
+def shard_for_new_user(user_id, shard_count):
+    """Shard a user is assigned to, users are spread evenly by id"""
+    return int(user_id) % shard_count
+
+
+def shard_of_user(user):
+    """Shard assigned to a user, users saved before sharding live in shard 0"""
+    return user.shard or 0
+
+
+@contextmanager
+def use_shard(shard):
+    """Route sharded models to the specified shard within the `with` block
+
+    Pending changes are flushed when entering and leaving the block, so that
+    they are written to the shard they were made for.
+    """
+    session = get_state(current_app).db.session if has_app_context() else None
+    if session is not None:
+        session.flush()
+    token = _selected_shard.set(shard)
+    try:
+        yield
+        if session is not None:
+            session.flush()
+    finally:
+        _selected_shard.reset(token)
+
+
+def current_shard():
+    """Shard that sharded models are currently routed to: the one selected
+    with `use_shard`, otherwise the shard of the logged in user, None if neither
+    """
+    shard = _selected_shard.get()
+    if shard is not None:
+        return shard
+    if has_request_context() and current_user.is_authenticated:
+        return shard_of_user(current_user)
+    return None
+
+
+class ShardedSession(SignallingSession):
+    """Session routing tables marked with `info={'sharded': True}` to the current shard"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is not None and mapper.persist_selectable.info.get('sharded'):
+            shard = current_shard()
+            if shard is None:
+                if self.app.config['SHARD_COUNT'] > 1:
+                    raise RuntimeError(f'No shard selected to access {mapper.class_.__name__}, '
+                                       'use "with use_shard(shard):" outside of a logged in request')
+                shard = 0
+            if shard:
+                return get_state(self.app).db.get_engine(self.app, bind=shard_bind_key(shard))
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy extension using `ShardedSession` for `db.session`"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardedSession, db=self, **options)
@@ -0,0 +1,185 @@
+"""This module holds the code maintaining the study statistics of users.
+
+`StudyStats` (per user) and the `cards_total`/`cards_mastered` columns of
+`Deck` (per deck) are updated incrementally by the code paths that add,
+remove and learn flashcards, within their own transaction, so reading the
+statistics never scans the flashcards of a user. The `reconcile-stats`
+command recomputes the counters from the flashcards to fix any drift, and
+is meant to be scheduled nightly:
+
+```
+cd app && FLASK_APP=run flask reconcile-stats
+```
+
+"""
+from datetime import date, timedelta
+
+import click
+
+from myapp import myapp_obj, db
+from myapp.models import StudyStats, Deck, FlashCard, User
+from myapp.sharding import configured_shards, use_shard
+
+MASTERED = StudyStats.MASTERED_LEARNED_COUNT
+
+
+def _get_or_create(user_id):
+    stats = StudyStats.query.get(int(user_id))
+    if stats is None:
+        stats = StudyStats(user_id=int(user_id), cards_total=0, cards_mastered=0,
+                           reviewed_today=0, streak_current=0, streak_longest=0)
+        db.session.add(stats)
+    return stats
+
+
+def _increment(model, key_column, key, **deltas):
+    """Atomically add `deltas` to the counters of one row"""
+    values = {name: getattr(model, name) + delta for name, delta in deltas.items()}
+    model.query.filter(key_column == key).update(values, synchronize_session=False)
+
+
+def record_cards_added(user_id, deck_counts=None, total=None):
+    """Record flashcards added to a user, none of them are mastered yet
+
+    Arguments:
+        user_id: id of owner user of the flashcards
+        deck_counts: dict mapping deck_id (or None) to number of flashcards added to it
+        total: Number of flashcards added, defaults to the sum of `deck_counts`
+    """
+    deck_counts = deck_counts or {}
+    total = sum(deck_counts.values()) if total is None else total
+    _get_or_create(user_id)
+    db.session.flush()
+    _increment(StudyStats, StudyStats.user_id, int(user_id), cards_total=total)
+    for deck_id, count in deck_counts.items():
+        if deck_id is not None and count:
+            _increment(Deck, Deck.id, deck_id, cards_total=count)
+
+
+def record_cards_removed(user_id, cards):
+    """Record flashcards removed from a user, call it before deleting them
+
+    Arguments:
+        user_id: id of owner user of the flashcards
+        cards: Iterable of `(deck_id, learned)` of the removed flashcards
+    """
+    total = mastered = 0
+    decks = {}
+    for deck_id, learned in cards:
+        is_mastered = int((learned or 0) >= MASTERED)
+        total += 1
+        mastered += is_mastered
+        if deck_id is not None:
+            deck_total, deck_mastered = decks.get(deck_id, (0, 0))
+            decks[deck_id] = (deck_total + 1, deck_mastered + is_mastered)
+    _get_or_create(user_id)
+    db.session.flush()
+    _increment(StudyStats, StudyStats.user_id, int(user_id), cards_total=-total, cards_mastered=-mastered)
+    for deck_id, (deck_total, deck_mastered) in decks.items():
+        _increment(Deck, Deck.id, deck_id, cards_total=-deck_total, cards_mastered=-deck_mastered)
+
+
+def record_review(card, correct, today=None):
+    """Record an answer to a flashcard, call it after updating `card.learned`
+
+    Arguments:
+        card: The answered `FlashCard`
+        correct: Whether the answer was correct
+        today: Date of the answer, defaults to today. Answers older than the last study day
+            (uploaded by an offline client) only count towards mastered flashcards
+    """
+    today = today or date.today()
+    stats = _get_or_create(card.user_id)
+    if stats.last_study_date is not None and today < stats.last_study_date:
+        pass # Answer given offline before the last study day, the streak isn't rewound
+    elif stats.last_study_date == today:
+        stats.reviewed_today += 1
+    else:
+        stats.reviewed_today = 1
+        if stats.last_study_date == today - timedelta(days=1):
+            stats.streak_current += 1
+        else:
+            stats.streak_current = 1
+        stats.streak_longest = max(stats.streak_longest, stats.streak_current)
+        stats.last_study_date = today
+    if correct and card.learned == MASTERED: # Just became mastered
+        db.session.flush()
+        _increment(StudyStats, StudyStats.user_id, card.user_id, cards_mastered=1)
+        if card.deck_id is not None:
+            _increment(Deck, Deck.id, card.deck_id, cards_mastered=1)
+
+
+def get_stats(user_id, today=None):
+    """Function returning study statistics of the specified user
+
+    Arguments:
+        user_id: id of the user
+        today: Date to compute "reviewed today" and streak for, defaults to today
+
+    Returns:
+        dict: Statistics of the user, with a list of per-deck counters under 'decks'
+    """
+    today = today or date.today()
+    stats = StudyStats.query.get(int(user_id)) or StudyStats(cards_total=0, cards_mastered=0, reviewed_today=0,
+                                                             streak_current=0, streak_longest=0)
+    studied_recently = stats.last_study_date is not None and stats.last_study_date >= today - timedelta(days=1)
+    decks = Deck.query.with_entities(Deck.id, Deck.name, Deck.cards_total, Deck.cards_mastered)\
+                .filter_by(user_id=user_id).order_by(Deck.name).all()
+    return {
+        'cards_total': stats.cards_total,
+        'cards_mastered': stats.cards_mastered,
+        'reviewed_today': stats.reviewed_today if stats.last_study_date == today else 0,
+        'streak_current': stats.streak_current if studied_recently else 0,
+        'streak_longest': stats.streak_longest,
+        'last_study_date': stats.last_study_date.isoformat() if stats.last_study_date else None,
+        'decks': [dict(id=d.id, name=d.name, cards_total=d.cards_total, cards_mastered=d.cards_mastered)
+                  for d in decks],
+    }
+
+
+def _reconcile_shard(shard):
+    mastered = db.func.sum(db.case([(FlashCard.learned >= MASTERED, 1)], else_=0))
+    user_counts = {row.user_id: (row.total, row.mastered or 0) for row in
+                   db.session.query(FlashCard.user_id, db.func.count(FlashCard.id).label('total'),
+                                    mastered.label('mastered')).group_by(FlashCard.user_id)}
+    deck_counts = {row.deck_id: (row.total, row.mastered or 0) for row in
+                   db.session.query(FlashCard.deck_id, db.func.count(FlashCard.id).label('total'),
+                                    mastered.label('mastered')).group_by(FlashCard.deck_id)}
+    corrected = 0
+    for (user_id,) in db.session.query(User.id).filter(db.func.coalesce(User.shard, 0) == shard):
+        total, mastered_count = user_counts.get(user_id, (0, 0))
+        stats = _get_or_create(user_id)
+        if (stats.cards_total, stats.cards_mastered) != (total, mastered_count):
+            stats.cards_total, stats.cards_mastered = total, mastered_count
+            corrected += 1
+    for deck in Deck.query:
+        total, mastered_count = deck_counts.get(deck.id, (0, 0))
+        if (deck.cards_total, deck.cards_mastered) != (total, mastered_count):
+            deck.cards_total, deck.cards_mastered = total, mastered_count
+    db.session.flush()
+    return corrected
+
+
+def reconcile_stats():
+    """Recompute the flashcard counters of all users and decks from the flashcards table
+    of every shard
+
+    Review counters and streaks can't be recomputed (answers aren't saved individually),
+    so they are kept as is.
+
+    Returns:
+        int: Number of users whose counters were corrected
+    """
+    corrected = 0
+    for shard in configured_shards(myapp_obj.config):
+        with use_shard(shard):
+            corrected += _reconcile_shard(shard)
+    db.session.commit()
+    return corrected
+
+
+@myapp_obj.cli.command('reconcile-stats')
+def reconcile_stats_command():
+    """Recompute study statistics counters from the flashcards table"""
+    corrected = reconcile_stats()
+    click.echo(f'Reconciled study statistics, corrected {corrected} users')
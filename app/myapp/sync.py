@@ -0,0 +1,217 @@
+"""This module holds the versioned JSON sync API, for clients studying offline.
+
+A client downloads the flashcards changed since its cursor, studies offline,
+then uploads all its answers in one request:
+
+```
+GET  /api/v1/sync/flashcards?cursor=<cursor>&limit=500
+     -> {"cards": [...], "deleted": [ids], "cursor": "...", "has_more": false}
+POST /api/v1/sync/reviews
+     {"events": [{"key": "<unique>", "card_id": 1, "correct": true, "reviewed_at": "2021-11-30T10:00:00"}]}
+     -> {"applied": [keys], "duplicates": [keys], "rejected": [{"key": ..., "error": ...}], "cards": [...]}
+```
+
+Changes are paged in `(change_seq, id)` order, deletions come from
+`DeletedFlashCard`. `change_seq` is a per-user sequence number assigned in the
+transaction writing the flashcard (see `myapp.models.next_change_seq`), so
+unlike timestamps, a change can't be committed behind a cursor already
+returned to a client. Clients apply `deleted` before `cards`, store the
+returned cursor, and request again while `has_more` is true. Without a
+cursor, all flashcards are returned. Times are UTC.
+
+Review events are applied in a single transaction. Every event has a key
+chosen by the client (like a UUID), events whose key was already applied are
+reported as duplicates and skipped, so a failed upload can be retried safely.
+When two uploads apply the same key at once, the later one is applied again,
+reporting the events of the first one as duplicates.
+
+"""
+from datetime import datetime, date, timezone
+
+from flask import request, jsonify
+from flask_login import current_user, login_required
+from sqlalchemy.exc import IntegrityError
+
+from myapp import myapp_obj, db, stats
+from myapp.models import FlashCard, DeletedFlashCard, ReviewEvent
+
+API_VERSION = 1
+API_PREFIX = f'/api/v{API_VERSION}/sync'
+
+
+class SyncError(Exception):
+    """Raised on an invalid sync request, the message is returned to the client"""
+    status_code = 400
+
+
+class SyncConflict(SyncError):
+    """Raised when events with the same keys are applied by another request at the same time"""
+    status_code = 409
+
+
+def _card_json(card):
+    return dict(id=card.id, front=card.front, back=card.back, learned=card.learned, view=card.view,
+                deck_id=card.deck_id, section_id=card.section_id,
+                updated_at=card.updated_at.isoformat() if card.updated_at else None)
+
+
+def encode_cursor(change_seq, row_id):
+    return f'{change_seq}~{row_id}'
+
+
+def decode_cursor(cursor):
+    """Parse a cursor returned by `flashcard_changes`, raise `SyncError` if it's invalid
+    (like the timestamp cursors of older versions, clients then download all flashcards again)
+    """
+    try:
+        change_seq, row_id = cursor.split('~')
+        return int(change_seq), int(row_id)
+    except ValueError:
+        raise SyncError(f'Invalid cursor "{cursor}"')
+
+
+def flashcard_changes(user_id, cursor=None, limit=500):
+    """Function returning the flashcards of a user changed (or deleted) after a cursor
+
+    Arguments:
+        user_id: id of the user
+        cursor: Cursor returned by the previous call, None to get all flashcards
+        limit: Largest number of changes returned
+
+    Returns:
+        dict: `cards` changed, ids of `deleted` cards, the `cursor` to pass to the next
+        call and whether there are more changes (`has_more`)
+    """
+    cards = FlashCard.query.filter(FlashCard.user_id == user_id)
+    deleted = DeletedFlashCard.query.filter(DeletedFlashCard.user_id == user_id)
+    if cursor is not None:
+        change_seq, row_id = decode_cursor(cursor)
+        cards = cards.filter(db.tuple_(FlashCard.change_seq, FlashCard.id) > db.tuple_(change_seq, row_id))
+        deleted = deleted.filter(db.tuple_(DeletedFlashCard.change_seq, DeletedFlashCard.id)
+                                 > db.tuple_(change_seq, row_id))
+    else:
+        deleted = deleted.filter(db.false()) # A full download has nothing to delete
+    cards = cards.order_by(FlashCard.change_seq, FlashCard.id).limit(limit + 1).all()
+    deleted = deleted.order_by(DeletedFlashCard.change_seq, DeletedFlashCard.id).limit(limit + 1).all()
+    # Merge both pages in (change_seq, id) order, then keep the first `limit` changes
+    changes = sorted([(card.change_seq or 0, card.id, card) for card in cards]
+                     + [(row.change_seq or 0, row.id, None) for row in deleted], key=lambda change: change[:2])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return {
+        'cards': [_card_json(card) for _, _, card in changes if card is not None],
+        'deleted': [row_id for _, row_id, card in changes if card is None],
+        'cursor': encode_cursor(*changes[-1][:2]) if changes else cursor,
+        'has_more': has_more,
+    }
+
+
+def _parse_event(event):
+    if not isinstance(event, dict):
+        raise SyncError('Event must be an object')
+    key, card_id, correct = event.get('key'), event.get('card_id'), event.get('correct')
+    if not isinstance(key, str) or not 0 < len(key) <= 64:
+        raise SyncError('"key" must be a string of 1 to 64 characters')
+    if not isinstance(card_id, int) or isinstance(card_id, bool):
+        raise SyncError('"card_id" must be an integer')
+    if not isinstance(correct, bool):
+        raise SyncError('"correct" must be a boolean')
+    reviewed_at = datetime.utcnow()
+    if event.get('reviewed_at') is not None:
+        try:
+            reviewed_at = min(datetime.fromisoformat(str(event['reviewed_at'])), reviewed_at)
+        except (ValueError, TypeError):
+            raise SyncError('"reviewed_at" must be an ISO 8601 datetime without timezone')
+    return key, card_id, correct, reviewed_at
+
+
+def apply_review_events(user_id, events):
+    """Apply answers to flashcards given offline, in a single transaction
+
+    Each answer counts as a view of the flashcard, and correct answers as learned,
+    like in the Learn Flashcard page.
+
+    Arguments:
+        user_id: id of the user that answered
+        events: List of review event objects, see the module documentation
+
+    Returns:
+        dict: Keys of `applied` and `duplicates` events, `rejected` events with their
+        error, and the `cards` updated by the applied events
+    """
+    parsed, rejected = [], []
+    for event in events:
+        try:
+            parsed.append(_parse_event(event))
+        except SyncError as e:
+            rejected.append(dict(key=event.get('key') if isinstance(event, dict) else None, error=str(e)))
+    keys = {key for key, _, _, _ in parsed}
+    seen = {key for (key,) in db.session.query(ReviewEvent.key)
+                                .filter(ReviewEvent.user_id == user_id, ReviewEvent.key.in_(keys))} if keys else set()
+    card_ids = {card_id for _, card_id, _, _ in parsed}
+    cards = {card.id: card for card in
+             FlashCard.query.filter(FlashCard.user_id == user_id, FlashCard.id.in_(card_ids))} if card_ids else {}
+    applied, duplicates, updated = [], [], {}
+    for key, card_id, correct, reviewed_at in sorted(parsed, key=lambda event: event[3]):
+        if key in seen:
+            duplicates.append(key)
+            continue
+        card = cards.get(card_id)
+        if card is None:
+            rejected.append(dict(key=key, error=f'Unable to find flashcard with id {card_id}'))
+            continue
+        seen.add(key)
+        card.view = (card.view or 0) + 1
+        if correct:
+            card.learned = (card.learned or 0) + 1
+        # Statistics count days in local time, like the Learn Flashcard page
+        local_date = reviewed_at.replace(tzinfo=timezone.utc).astimezone().date()
+        stats.record_review(card, correct=correct, today=min(local_date, date.today()))
+        db.session.add(ReviewEvent(user_id=user_id, key=key, flashcard_id=card_id, correct=correct,
+                                   reviewed_at=reviewed_at))
+        applied.append(key)
+        updated[card.id] = card
+    try:
+        db.session.commit()
+    except IntegrityError: # The unique key of an event was saved by another request since it was read
+        db.session.rollback()
+        raise SyncConflict('Events with the same keys are being applied by another request, retry the upload')
+    return {
+        'applied': applied,
+        'duplicates': duplicates,
+        'rejected': rejected,
+        'cards': [_card_json(card) for card in updated.values()],
+    }
+
+
+@myapp_obj.errorhandler(SyncError)
+def sync_error(e):
+    return jsonify(error=str(e), api_version=API_VERSION), e.status_code
+
+
+@myapp_obj.route(f"{API_PREFIX}/flashcards")
+@login_required
+def sync_flashcards():
+    """Flashcards of current user changed since the `cursor` query parameter, as json"""
+    limit = request.args.get('limit', myapp_obj.config['SYNC_PAGE_SIZE'], type=int)
+    if not 0 < limit <= myapp_obj.config['SYNC_PAGE_SIZE']:
+        raise SyncError(f'"limit" must be between 1 and {myapp_obj.config["SYNC_PAGE_SIZE"]}')
+    changes = flashcard_changes(int(current_user.get_id()), request.args.get('cursor'), limit)
+    return jsonify(api_version=API_VERSION, **changes)
+
+
+@myapp_obj.route(f"{API_PREFIX}/reviews", methods=['POST'])
+@login_required
+def sync_reviews():
+    """Apply a batch of answers given offline by current user, see `apply_review_events`"""
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get('events'), list):
+        raise SyncError('Body must be a json object with a list of "events"')
+    if len(body['events']) > myapp_obj.config['SYNC_MAX_EVENTS']:
+        raise SyncError(f'At most {myapp_obj.config["SYNC_MAX_EVENTS"]} events can be uploaded at once')
+    try:
+        result = apply_review_events(int(current_user.get_id()), body['events'])
+    except SyncConflict:
+        # The other request has committed, its events are now reported as duplicates
+        result = apply_review_events(int(current_user.get_id()), body['events'])
+    return jsonify(api_version=API_VERSION, **result)
@@ -0,0 +1,146 @@
+"""This module holds the upgrade of existing databases to the current schema.
+
+`db.create_all()` creates the missing tables, but doesn't change the tables
+that already exist, so a database created by an older version of the app lacks
+the new columns (like `FlashCard.deck_id` or `User.data_version`) and indexes.
+`upgrade-db` adds them to the main database and to every shard, then fills the
+new columns of existing rows where needed, and drops the indexes replaced in
+`OBSOLETE_INDEXES`. It only changes what's out of date, so it can be run after
+every deploy:
+
+```
+cd app && FLASK_APP=run flask upgrade-db
+cd app && FLASK_APP=run flask reconcile-stats   # Compute the statistics of existing flashcards
+```
+
+Columns are added with SQLite's `ALTER TABLE ... ADD COLUMN`, so columns
+that are `NOT NULL` need a scalar default. Table options can't be changed
+this way: flashcard ids of an upgraded main database are not `AUTOINCREMENT`.
+
+"""
+from datetime import datetime
+
+import click
+from sqlalchemy.schema import CreateColumn
+
+from myapp import myapp_obj, db
+from myapp.models import FlashCard, DeletedFlashCard, flashcard_hash
+from myapp.rebalance import create_shards, sharded_tables
+from myapp.sharding import shard_bind_key, configured_shards
+
+
+# Indexes of older versions that were replaced, by table name
+OBSOLETE_INDEXES = {
+    'flash_card': ['ix_flash_card_user_id_updated_at', 'ix_flash_card_user_id_content_hash', 'ix_flash_card_user_id',
+                   'ix_flash_card_deck_id'],
+    'deleted_flash_card': ['ix_deleted_flash_card_user_id_deleted_at'],
+}
+
+
+class UpgradeError(Exception):
+    """Raised when a missing column can't be added to an existing table"""
+
+
+def _column_definition(column, dialect):
+    """DDL of a column for `ALTER TABLE ... ADD COLUMN`, with its scalar default"""
+    definition = str(CreateColumn(column).compile(dialect=dialect))
+    if column.default is not None and column.default.is_scalar:
+        default = db.literal(column.default.arg, type_=column.type)
+        definition += ' DEFAULT ' + str(default.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    elif not column.nullable:
+        raise UpgradeError(f'Column {column.table.name}.{column.name} is NOT NULL without a scalar default, '
+                           'it can\'t be added to an existing table')
+    return definition
+
+
+def _backfill_flashcards(conn, batch_size=500):
+    """Fill `content_hash` and `updated_at` of flashcards saved before these columns existed
+
+    Returns:
+        int: Number of flashcards updated
+    """
+    card = FlashCard.__table__
+    now, count = datetime.utcnow(), 0
+    while True:
+        rows = conn.execute(db.select(card.c.id, card.c.front)
+                              .where(card.c.content_hash.is_(None) | card.c.updated_at.is_(None))
+                              .limit(batch_size)).all()
+        if not rows:
+            return count
+        conn.execute(db.update(card).where(card.c.id == db.bindparam('card_id'))
+                       .values(content_hash=db.bindparam('hash'), updated_at=now),
+                     [{'card_id': row.id, 'hash': flashcard_hash(row.front or '')} for row in rows])
+        count += len(rows)
+
+
+def upgrade_database(engine, tables):
+    """Add the missing columns and indexes of the specified tables to a database,
+    the tables must already exist (see `myapp.rebalance.create_shards`)
+
+    Arguments:
+        engine: Engine of the database to upgrade
+        tables: Tables of the metadata saved in this database
+
+    Returns:
+        list: Descriptions of the changes made, empty if the database was up to date
+    """
+    changes = []
+    with engine.begin() as conn:
+        inspector = db.inspect(conn)
+        for table in tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    conn.execute(db.text(f'ALTER TABLE {conn.dialect.identifier_preparer.format_table(table)} '
+                                         f'ADD COLUMN {_column_definition(column, conn.dialect)}'))
+                    changes.append(f'Added column {table.name}.{column.name}')
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for name in OBSOLETE_INDEXES.get(table.name, []):
+                if name in indexes:
+                    conn.execute(db.text(f'DROP INDEX {conn.dialect.identifier_preparer.quote(name)}'))
+                    changes.append(f'Dropped index {name}')
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    changes.append(f'Created index {index.name}')
+        if FlashCard.__table__ in tables:
+            count = _backfill_flashcards(conn)
+            if count:
+                changes.append(f'Filled content_hash and updated_at of {count} flashcards')
+            # Changes saved before sequence numbers existed are older than any sequence number
+            for model in (FlashCard, DeletedFlashCard):
+                count = conn.execute(db.update(model.__table__).where(model.change_seq.is_(None))
+                                       .values(change_seq=0)).rowcount
+                if count:
+                    changes.append(f'Filled change_seq of {count} {model.__table__.name} rows')
+    return changes
+
+
+def upgrade_all_databases():
+    """Create the missing tables, then add the missing columns and indexes, in the main database and every shard
+
+    Returns:
+        dict: Mapping of shards (0 being the main database) to the changes made to them
+    """
+    create_shards()
+    changes = {}
+    for shard in configured_shards(myapp_obj.config):
+        engine = db.get_engine(myapp_obj, bind=shard_bind_key(shard))
+        tables = db.metadata.sorted_tables if shard == 0 else sharded_tables()
+        changes[shard] = upgrade_database(engine, tables)
+    return changes
+
+
+@myapp_obj.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Add the tables, columns and indexes missing from the main database and the shards"""
+    try:
+        changes = upgrade_all_databases()
+    except UpgradeError as e:
+        raise click.ClickException(str(e))
+    for shard, shard_changes in changes.items():
+        name = f'Shard {shard}' if shard else 'Main database'
+        for change in shard_changes:
+            click.echo(f'{name}: {change}')
+    if not any(changes.values()):
+        click.echo('Databases are up to date')
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import threading
 import webbrowser
-from myapp import myapp_obj, db
+from myapp import myapp_obj
+from myapp.rebalance import create_shards
 
 DEBUG = False
 
@@ -9,9 +10,9 @@ def launch_browser():
     webbrowser.open(f'http://localhost:{PORT_NUMBER}', new=0)
 
 
-# Create *.db file from schema (if doesn't exists)
+# Create *.db files of the main database and shards from schema (if doesn't exists)
 try:
-    db.create_all()
+    create_shards()
 except:
     pass
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Fuzz and benchmark harness for `myapp.mdparser`
+
+Fuzzing feeds random markdown-like text into `md2flashcard` and checks that it
+never raises, then checks that randomly generated tables (with escaped pipes,
+extra columns and CRLF line endings), and random cards exported with
+`flashcard2md` (with `#` anywhere in their text), are parsed back into the
+same cards.
+Benchmarking parses normal and adversarial inputs of growing size and prints
+the time spent per input byte, which should stay roughly constant.
+
+Usage (from the repository root):
+
+    python etc/bench_mdparser.py [--seed N] [--fuzz-rounds N] [--max-size BYTES]
+
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+# mdparser has no dependency on the rest of the app, import it without creating the flask app
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'myapp'))
+
+from mdparser import md2flashcard, Flashcard, _parse_tabular_card_syntax, md_header, md_section, flashcard2md
+
+FUZZ_ALPHABET = ['|', '\\', '-', ':', ' ', '\t', '\n', '\r\n', '?', '#', '## ', 'a', 'front', 'back', '---']
+
+
+def _random_cell(rng):
+    words = [rng.choice(['a', 'b|c', 'x\\|y', 'word', '42']) for _ in range(rng.randint(1, 4))]
+    return ' '.join(words)
+
+
+def fuzz_random_text(rng, rounds):
+    """`md2flashcard` must not raise on random markdown-like text, except
+    for the documented "multiple header1" exception
+    """
+    for _ in range(rounds):
+        tokens = [rng.choice(FUZZ_ALPHABET) for _ in range(rng.randint(0, 200))]
+        data = '# Markdown Flashcards\n\n## Fuzz\n\n' + ''.join(tokens)
+        try:
+            md2flashcard(data)
+        except Exception as e:
+            if 'multiple header1' not in str(e):
+                raise AssertionError(f'Unexpected {e!r} on input {data!r}')
+
+
+def fuzz_table_roundtrip(rng, rounds):
+    """Cards written as a table must be parsed back unchanged"""
+    for _ in range(rounds):
+        cards = [Flashcard(_random_cell(rng).replace('\\|', '|'), _random_cell(rng).replace('\\|', '|'))
+                 for _ in range(rng.randint(1, 20))]
+        newline = rng.choice(['\n', '\r\n'])
+        extra = ' extra |' if rng.random() < 0.5 else ''
+        rows = ['| Front | Back |' + (' Notes |' if extra else ''), '| --- | :---: |' + (' --- |' if extra else '')]
+        for card in cards:
+            front = card.front.replace('|', '\\|')
+            back = card.back.replace('|', '\\|')
+            rows.append(f'| {front} | {back} |{extra}')
+        parsed = _parse_tabular_card_syntax(newline.join(rows) + newline)
+        assert parsed == cards, f'{parsed!r} != {cards!r}'
+
+
+EXPORT_WORDS = ['a', 'C#', '# ', '#', '## heading', 'word', '?', '---', 'x|y', '42']
+
+
+def fuzz_export_roundtrip(rng, rounds):
+    """Cards exported with `flashcard2md` must be parsed back unchanged"""
+    # Cards that used to break the export, a front containing "# " was read as a heading
+    fixed = [Flashcard('Who made C# ?', 'Microsoft'), Flashcard('# not a heading', '## neither')]
+    for i in range(rounds):
+        cards = fixed if i == 0 else [
+            Flashcard(' '.join(rng.choice(EXPORT_WORDS) for _ in range(rng.randint(1, 5))),
+                      ' '.join(rng.choice(EXPORT_WORDS) for _ in range(rng.randint(1, 5))))
+            for _ in range(rng.randint(1, 10))]
+        data = md_header('Fuzz') + ''.join(flashcard2md(card.front, card.back) for card in cards)\
+               + md_section('Other') + flashcard2md('front', 'back')
+        expected = {'Fuzz': [Flashcard(' '.join(c.front.split()), ' '.join(c.back.split())) for c in cards],
+                    'Other': [Flashcard('front', 'back')]}
+        parsed = md2flashcard(data)
+        assert parsed == expected, f'{parsed!r} != {expected!r}'
+
+
+def _table(size):
+    row = '| what is the front | this is the back |\n'
+    return '| Front | Back |\n| --- | --- |\n' + row * (size // len(row))
+
+
+def _long_row(size):
+    return '| Front | Back |\n| --- | --- |\n|' + ' a' * (size // 2)
+
+
+def _many_pipes(size):
+    return '| Front | Back |\n| --- | --- |\n' + '|' * size
+
+
+def _many_headers(size):
+    header = '| Front | Back |\n| --- | --- |\n'
+    return header * (size // len(header))
+
+
+BENCHMARKS = {
+    'table': _table,
+    'long row': _long_row,
+    'many pipes': _many_pipes,
+    'many headers': _many_headers,
+}
+
+
+def benchmark(max_size):
+    """Print parse time per input byte for each benchmark input"""
+    print(f'{"input":<14}{"bytes":>10}{"seconds":>12}{"ns/byte":>10}')
+    for name, generate in BENCHMARKS.items():
+        size = 1024
+        while size <= max_size:
+            data = '# Markdown Flashcards\n\n## Bench\n\n' + generate(size)
+            start = time.perf_counter()
+            md2flashcard(data)
+            elapsed = time.perf_counter() - start
+            print(f'{name:<14}{len(data):>10}{elapsed:>12.5f}{elapsed / len(data) * 1e9:>10.1f}')
+            size *= 4
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fuzz-rounds', type=int, default=2000)
+    parser.add_argument('--max-size', type=int, default=4 * 1024 * 1024)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    fuzz_random_text(rng, args.fuzz_rounds)
+    fuzz_table_roundtrip(rng, args.fuzz_rounds)
+    fuzz_export_roundtrip(rng, args.fuzz_rounds)
+    print(f'Fuzzing passed ({args.fuzz_rounds} rounds each, seed={args.seed})')
+    benchmark(args.max_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Memory benchmark of the main routes, with per-route allocation budgets
+
+A user with one imported deck of `--cards` flashcards is created in a temporary
+database, then each route below is requested through the test client with
+`PROFILE_MEMORY` enabled (see `myapp.profiling`). The peak memory allocated per
+endpoint is printed with its top allocation sites, and the script exits with
+status 1 when an endpoint goes over the budget given with `--budget`, so it can
+run in CI to catch memory regressions.
+
+Usage (from the repository root):
+
+    python etc/bench_memory.py [--cards N] [--top N] [--budget ENDPOINT=BYTES ...]
+
+"""
+import io
+import os
+import sys
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+ROUTES = [
+    ('GET', '/my-flashcards'),
+    ('GET', '/learn-flashcard'),
+    ('GET', '/my-decks'),
+    ('GET', '/my-stats'),
+    ('GET', '/api/stats'),
+    ('GET', '/flashcards-sharing'),
+    ('GET', '/note'),
+    ('GET', '/account'),
+]
+
+
+def _deck_markdown(cards):
+    rows = ''.join(f'| front of card {i} | back of card {i} |\n' for i in range(cards))
+    return f'# Markdown Flashcards\n\n## Bench\n\n| Front | Back |\n| --- | --- |\n{rows}'
+
+
+def _parse_budget(value):
+    endpoint, _, size = value.partition('=')
+    if not endpoint or not size.isdigit():
+        raise argparse.ArgumentTypeError(f'Budget "{value}" is not in the format ENDPOINT=BYTES')
+    return endpoint, int(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cards', type=int, default=2000)
+    parser.add_argument('--top', type=int, default=3, help='Allocation sites printed per endpoint')
+    parser.add_argument('--budget', type=_parse_budget, action='append', default=[],
+                        help='Most bytes a request of ENDPOINT may allocate, like show_flashcard=8000000')
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    from myapp import myapp_obj, db
+    from myapp.profiling import endpoint_memory_stats, reset_memory_stats
+    myapp_obj.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(temp_dir, 'bench.db'),
+        WTF_CSRF_ENABLED=False,
+        PROFILE_MEMORY_TOP=args.top,
+    )
+    db.create_all()
+    client = myapp_obj.test_client()
+    client.post('/signup', data=dict(email='bench@example.com', username='bench', password='bench', password2='bench'))
+    client.post('/login', data=dict(username='bench', password='bench'))
+    client.post('/import-flashcard', data={'file': (io.BytesIO(_deck_markdown(args.cards).encode()), 'bench.md')},
+                content_type='multipart/form-data')
+
+    myapp_obj.config.update(PROFILE_MEMORY=True, MEMORY_BUDGETS=dict(args.budget))
+    reset_memory_stats()
+    for method, path in ROUTES:
+        response = client.open(path, method=method)
+        if response.status_code >= 400:
+            print(f'{method} {path} returned {response.status_code}')
+            sys.exit(1)
+
+    failed = False
+    print(f'{"endpoint":<24}{"peak bytes":>14}{"budget":>14}')
+    for endpoint, stats in sorted(endpoint_memory_stats().items(), key=lambda item: -item[1]['peak']):
+        budget = myapp_obj.config['MEMORY_BUDGETS'].get(endpoint)
+        over = budget is not None and stats['peak'] > budget
+        failed = failed or over
+        print(f'{endpoint:<24}{stats["peak"]:>14}{budget if budget is not None else "-":>14}{"  OVER BUDGET" if over else ""}')
+        for site in stats['top']:
+            print(f'    {site["site"]}: {site["size_diff"]} bytes in {site["count_diff"]} blocks')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
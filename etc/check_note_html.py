@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Check that `myapp.models.render_note_html` neutralises html and script urls
+
+Every case below is rendered, and the script exits with status 1 when an
+unsafe case still has a `href`/`src` attribute, raw html, or a safe case lost
+its url. Encoded forms (entities, whitespace and control characters) are read
+by browsers as the plain scheme, so they must be removed as well.
+
+Usage (from the repository root):
+
+    python etc/check_note_html.py
+
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+
+UNSAFE = [
+    '[x](javascript:alert(1))',
+    '[x](&#106;avascript:alert(1))',
+    '[x](java&#115;cript:alert(1))',
+    '[x](&#x6A;avascript:alert(1))',
+    '[x](&#0000106avascript:alert(1))',
+    '[x](javascript&colon;alert(1))',
+    '[x](java&#09;script:alert(1))',
+    '[x](&#x20;javascript:alert(1))',
+    '[x][ref]\n\n[ref]: &#106;avascript:alert(1)',
+    '![x](&#x6A;avascript:alert(1))',
+    '[x](data:text/html;base64,PHNjcmlwdD5hbGVydCgxKTwvc2NyaXB0Pg==)',
+    '[x](vbscript:msgbox(1))',
+]
+RAW_HTML = [
+    '<script>alert(1)</script>',
+    '<img src=x onerror=alert(1)>',
+    'text <a href="javascript:alert(1)">x</a>',
+]
+SAFE = [
+    ('[x](https://example.com/?a=1&amp;b=2)', 'href="https://example.com/?a=1&amp;b=2"'),
+    ('[x](http://example.com)', 'href="http://example.com"'),
+    ('[x](mailto:me@example.com)', 'href="mailto:me@example.com"'),
+    ('[x](notes/other.md)', 'href="notes/other.md"'),
+    ('![x](images/cat.png)', 'src="images/cat.png"'),
+]
+
+
+def main():
+    from myapp.models import render_note_html
+    failed = []
+    for source in UNSAFE:
+        html = render_note_html(source)
+        if 'href=' in html or 'src=' in html:
+            failed.append((source, html))
+    for source in RAW_HTML:
+        html = render_note_html(source)
+        if '<script' in html or '<img' in html or '<a ' in html:
+            failed.append((source, html))
+    for source, expected in SAFE:
+        html = render_note_html(source)
+        if expected not in html:
+            failed.append((source, html))
+    for source, html in failed:
+        print(f'FAILED {source!r} rendered as {html!r}')
+    print(f'{len(UNSAFE) + len(RAW_HTML) + len(SAFE) - len(failed)} passed, {len(failed)} failed')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()